@@ -0,0 +1,85 @@
+"""
+Module: import_time.py
+
+This script measures how long it takes to import the lightweight parts of the package (utils and SqlHandler) in a
+fresh interpreter, and fails if the import gets slower than a limit, pulls in a heavy dependency or has side effects
+(e.g. creating the database file).
+
+Usage:
+
+    python benchmarks/import_time.py [--repeat 5] [--max-seconds 1.0]
+
+Methods:
+
+- measure_import(statement: str) -> dict:
+    Runs an import statement in a fresh interpreter in an empty directory and reports its cost.
+
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imports a CLI job touching only utils or SqlHandler needs
+STATEMENT = ('from survival_analysis.utils import format_dataframe\n'
+             'from survival_analysis.database_preparation import SqlHandler')
+
+# Modules that must only be imported when the model, the schema or the API is used
+HEAVY_MODULES = ['lifelines', 'autograd', 'sqlalchemy', 'fastapi', 'uvicorn']
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+exec({statement!r})
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'modules': sorted(m for m in {heavy!r} if m in sys.modules)}}))
+'''
+
+
+def measure_import(statement: str = STATEMENT) -> dict:
+    """
+    Runs an import statement in a fresh interpreter in an empty directory and reports its cost.
+
+    Parameters:
+    - statement (str): The import statement to measure.
+
+    Returns:
+    - dict: The import time in seconds, the heavy modules that were loaded and the files created in the directory.
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+        output = subprocess.run([sys.executable, '-c', PROBE.format(statement=statement, heavy=HEAVY_MODULES)],
+                                cwd=workdir, env=env, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        result['files'] = sorted(os.listdir(workdir))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Guard the import time of survival_analysis.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=1.0,
+                        help='The largest accepted import time (best of the runs).')
+    args = parser.parse_args()
+
+    results = [measure_import() for _ in range(args.repeat)]
+    best = min(result['seconds'] for result in results)
+    print(f'import time: best {best:.3f}s, worst {max(result["seconds"] for result in results):.3f}s '
+          f'over {args.repeat} runs')
+
+    failures = []
+    if best > args.max_seconds:
+        failures.append(f'import took {best:.3f}s, more than {args.max_seconds:.3f}s')
+    if results[0]['modules']:
+        failures.append(f'heavy modules were imported: {", ".join(results[0]["modules"])}')
+    if results[0]['files']:
+        failures.append(f'the import created files: {", ".join(results[0]["files"])}')
+
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    sys.exit(1 if failures else 0)
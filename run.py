@@ -1,13 +1,48 @@
 #Importing libraries
+import argparse
 import uvicorn
 import os
 import fastapi
 
-from survival_analysis.api import app
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run the Survival Analysis API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--db', default=os.environ.get('SA_DB', 'sa_db'),
+                        help='Name of the SQLite database, without the .db extension (default: SA_DB or sa_db).')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes. With more than one, the ranking endpoints are served '
+                             'from a shared memory-mapped snapshot of FactPredictions.')
+    parser.add_argument('--snapshot-dir', default=None,
+                        help='Directory of the FactPredictions snapshot (default: prediction_snapshot when --workers > 1).')
+    parser.add_argument('--refresh-snapshot', action='store_true',
+                        help='Rebuild the snapshot from the database and exit (e.g. after a scoring run).')
+    return parser.parse_args()
+
 
 if __name__== "__main__":
-    uvicorn.run(app)
+    args = parse_args()
+    # Inherited by the worker processes, so the API serves the same database the snapshot is built from
+    os.environ['SA_DB'] = args.db
+    snapshot_dir = args.snapshot_dir or ('prediction_snapshot' if args.workers > 1 or args.refresh_snapshot else None)
+
+    if snapshot_dir:
+        from survival_analysis.api.snapshot import build_snapshot
+
+        # Building a fresh snapshot, the running workers switch to it atomically on their next request
+        os.makedirs(snapshot_dir, exist_ok=True)
+        build_snapshot(args.db, snapshot_dir)
+        if args.refresh_snapshot:
+            raise SystemExit(0)
+        # Inherited by the worker processes, which map the snapshot instead of querying SQLite for the rankings
+        os.environ['SA_SNAPSHOT_DIR'] = snapshot_dir
+
+    if args.workers > 1:
+        uvicorn.run("survival_analysis.api:app", host=args.host, port=args.port, workers=args.workers)
+    else:
+        from survival_analysis.api import app
+        uvicorn.run(app, host=args.host, port=args.port)
 
 # if __name__ == "__main__":
 #     uvicorn.run("run:app", host="127.0.0.1", port=8000, reload=True)
-
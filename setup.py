@@ -76,4 +76,7 @@ setup(
         'wrapt==1.16.0',
         'zope.interface==6.1',
     ],
+    extras_require={
+        'arrow': ['pyarrow'],
+    },
 )
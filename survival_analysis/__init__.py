@@ -1,4 +1,10 @@
-from . import logger
-from . import database_preparation
-from . import model_preparation
-from . import api
\ No newline at end of file
+import importlib
+
+# The subpackages are imported on first use, so that e.g. a job using only utils or SqlHandler
+# does not pay for importing lifelines, SQLAlchemy or FastAPI
+_SUBMODULES = ('logger', 'database_preparation', 'model_preparation', 'api', 'utils', 'metrics', 'profiling')
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
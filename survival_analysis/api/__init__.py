@@ -1,2 +1,8 @@
 from ..logger import CustomFormatter
-from .api import app
\ No newline at end of file
+
+def __getattr__(name):
+    # FastAPI is imported, and the default app created, only when they are first used
+    if name in ('app', 'create_app'):
+        from . import api
+        return getattr(api, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,53 +1,134 @@
-from fastapi import FastAPI, HTTPException, Query, File, UploadFile, Path
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, Request, HTTPException, Query, File, UploadFile, Path
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.encoders import jsonable_encoder
-from datetime import datetime
 import sqlite3
 import logging
-from ..logger import CustomFormatter
-from ..database_preparation import SqlHandler
+from ..logger import CustomFormatter, get_log_level
+from ..database_preparation import ConnectionPool, data_version
+from ..utils import normalize_fact_data
+from ..metrics import REGISTRY, CONTENT_TYPE, ENABLED as METRICS_ENABLED
+from .. import profiling
+from .snapshot import PredictionSnapshot
+from .cache import ResponseCache, etag_matches
+from .formats import Encoder, get_encoder, STREAMING_FORMATS
 import os
 import pandas as pd
-from typing import Any, List, Union, Optional
+from typing import Any, List, Union, Optional, NamedTuple
+import base64
+import json
+import time
 import traceback
 
-app = FastAPI()
-    
 logger = logging.getLogger(os.path.basename(__file__))
-logger.setLevel(logging.DEBUG)
+logger.setLevel(get_log_level(logger.name))
 ch = logging.StreamHandler()
 ch.setLevel(logging.DEBUG)
 ch.setFormatter(CustomFormatter())
 logger.addHandler(ch)
 
-# Creating instances of SqlHandler for each table
-dim_customer_handler = SqlHandler(dbname='sa_db', table_name='DimCustomer')
-fact_predictions_handler = SqlHandler(dbname='sa_db', table_name='FactPredictions')
-fact_push_notification_handler = SqlHandler(dbname='sa_db', table_name='FactPushNotification')
-fact_email_handler = SqlHandler(dbname='sa_db', table_name='FactEmail')
-
-# Defining functions to open connections to the databases
-def get_dim_customer_db():
-    return dim_customer_handler.cnxn
-
-def get_fact_predictions_db():
-    return fact_predictions_handler.cnxn
-
-def get_fact_push_notification_db():
-    return fact_push_notification_handler.cnxn
-
-def get_fact_email_db():
-    return fact_email_handler.cnxn
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    # Closing the database connections on shutdown
-    dim_customer_handler.close_cnxn()
-    fact_predictions_handler.close_cnxn()
-    fact_push_notification_handler.close_cnxn()
-    fact_email_handler.close_cnxn()
-
-@app.get("/")
+# The endpoints, added to the app by create_app
+router = APIRouter()
+
+# Metrics of the routes, rendered by /metrics
+HTTP_REQUESTS = REGISTRY.counter('sa_http_requests_total', 'HTTP requests handled.', ('method', 'route', 'status'))
+HTTP_SECONDS = REGISTRY.histogram('sa_http_request_seconds', 'Duration of the HTTP requests, until the response starts.',
+                                  ('method', 'route'))
+
+# The number of CSV rows read, validated and inserted at a time by the upload endpoints
+UPLOAD_CHUNKSIZE = 50000
+
+def create_app(db_path: str = 'sa_db', snapshot_dir: str = None, max_readers: int = None,
+               cache_size: int = 256, cache_ttl: float = None) -> FastAPI:
+    """
+    Creates the FastAPI app of the Survival Analysis API.
+
+    Parameters:
+    - db_path (str): The name of the SQLite database (without the .db extension).
+    - snapshot_dir (str): The directory of a FactPredictions snapshot (see snapshot.py). When given, the ranking
+      endpoints are answered from the memory-mapped snapshot instead of the database.
+    - max_readers (int): The number of reader threads of the connection pool (default: SA_DB_READERS or 8).
+    - cache_size (int): The number of ranking responses kept in the response cache, 0 to disable it.
+    - cache_ttl (float): The maximum age in seconds of a cached response (default: SA_RESPONSE_CACHE_TTL, or no limit).
+      The cache is invalidated by every commit to the database, including those of other processes
+      (e.g. a scoring job writing FactPredictions), and by snapshot swaps, so a ttl is not needed for freshness.
+
+    Returns:
+    - FastAPI: The app.
+    """
+    app = FastAPI()
+
+    # Creating the pool of connections: one read connection per worker thread and a dedicated writer connection
+    app.state.pool = ConnectionPool(dbname=db_path, max_readers=max_readers or int(os.environ.get('SA_DB_READERS', 8)))
+
+    # Serving the ranking endpoints from the shared read-only snapshot of FactPredictions when one is configured (see run.py)
+    app.state.snapshot = PredictionSnapshot(snapshot_dir) if snapshot_dir else None
+
+    # Caching the serialized ranking responses until FactPredictions (or the snapshot) changes
+    if cache_ttl is None and os.environ.get('SA_RESPONSE_CACHE_TTL'):
+        cache_ttl = float(os.environ['SA_RESPONSE_CACHE_TTL'])
+    app.state.response_cache = ResponseCache(max_entries=cache_size, ttl=cache_ttl) if cache_size > 0 else None
+
+    @app.on_event("shutdown")
+    async def shutdown_event():
+        # Closing the database connections on shutdown
+        app.state.pool.close()
+
+    if METRICS_ENABLED:
+        @app.middleware("http")
+        async def record_metrics(request: Request, call_next):
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = await call_next(request)
+                status = response.status_code
+                return response
+            finally:
+                # The route template (e.g. /get_top_clv_customers) is used as the label, not the raw URL
+                route = request.scope.get('route')
+                route = route.path if route is not None else 'unmatched'
+                HTTP_SECONDS.observe(time.perf_counter() - start, method=request.method, route=route)
+                HTTP_REQUESTS.inc(method=request.method, route=route, status=str(status))
+
+    if profiling.MODE != 'off':
+        @app.middleware("http")
+        async def profile_request(request: Request, call_next):
+            # With SA_PROFILE=header, only the requests sent with 'X-Profile: 1' are profiled
+            if profiling.MODE == 'header' and request.headers.get('x-profile', '').lower() not in ('1', 'true', 'on'):
+                return await call_next(request)
+
+            # Sampling every thread, as the database work of the request runs on the pool's threads.
+            # The profile ends when the response starts (before the body of a streaming response is sent)
+            with profiling.Profiler(f'{request.method} {request.url.path}', all_threads=True) as profiler:
+                response = await call_next(request)
+            response.headers['X-Profile-Id'] = profiler.profile_id
+            return response
+
+    app.include_router(router)
+    return app
+
+def __getattr__(name):
+    # The default app (e.g. for `uvicorn survival_analysis.api:app`) is only created when it is first used,
+    # so importing this module has no side effects
+    if name == 'app':
+        global app
+        app = create_app(os.environ.get('SA_DB', 'sa_db'), os.environ.get('SA_SNAPSHOT_DIR'))
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Defining functions to open connections to the databases (the connection of the calling thread), usable with Depends
+def get_dim_customer_db(request: Request):
+    return request.app.state.pool.handler('DimCustomer').cnxn
+
+def get_fact_predictions_db(request: Request):
+    return request.app.state.pool.handler('FactPredictions').cnxn
+
+def get_fact_push_notification_db(request: Request):
+    return request.app.state.pool.handler('FactPushNotification').cnxn
+
+def get_fact_email_db(request: Request):
+    return request.app.state.pool.handler('FactEmail').cnxn
+
+@router.get("/")
 async def root():
     return {
         """
@@ -55,129 +136,401 @@ async def root():
         """
     }
 
-def read_csv(file: UploadFile = File(...)):
-    content = pd.read_csv(file.file)
-    return content
-
-def validate_sent_date(sent_date):
+@router.get("/metrics")
+async def metrics():
+    # The counters and latency histograms of this process in the Prometheus text format
+    return Response(content=REGISTRY.render(), headers={'Content-Type': CONTENT_TYPE})
+
+def read_csv(file: UploadFile = File(...), chunksize: int = UPLOAD_CHUNKSIZE):
+    # Reading the upload as a stream of DataFrames of at most chunksize rows
+    return pd.read_csv(file.file, chunksize=chunksize)
+
+def load_csv_chunks(pool: ConnectionPool, table_name: str, file: UploadFile, chunksize: int = UPLOAD_CHUNKSIZE) -> dict:
+    """
+    Validates and inserts an uploaded CSV file chunk by chunk in a single transaction,
+    so the memory used does not depend on the size of the file.
+
+    Rows with an invalid or missing sent_date, customer_ID or success are rejected, the other rows are
+    normalized (ISO timestamps, integer IDs and flags) and inserted.
+    If an insert fails, the whole upload is rolled back. Meant to be run on the writer thread of the pool.
+
+    Parameters:
+    - pool (ConnectionPool): The connection pool of the app.
+    - table_name (str): The name of the table to populate.
+    - file (UploadFile): The uploaded CSV file.
+    - chunksize (int): The number of rows read, validated and inserted at a time.
+
+    Returns:
+    - dict: The number of accepted and rejected rows.
+    """
+    handler = pool.handler(table_name)
+    rows_accepted = 0
+    rows_rejected = 0
     try:
-        # Trying to parse the send_date as a datetime object
-        datetime.strptime(sent_date, '%d/%m/%Y')
-        return True
-    except ValueError:
-        return False
-
-@app.put("/populate_fact_push_notification")
-async def populate_fact_push_notification(file: UploadFile = File(...)):
+        for chunk in read_csv(file, chunksize):
+            # Validating and normalizing sent_date, customer_ID and success columns
+            chunk, errors = normalize_fact_data(chunk)
+            chunk = chunk[~errors]
+            rows_rejected += int(errors.sum())
+
+            handler.insert_many(chunk, commit=False)
+            rows_accepted += len(chunk)
+        handler.commit()
+    except Exception:
+        handler.cnxn.rollback()
+        raise
+    return {"rows_accepted": rows_accepted, "rows_rejected": rows_rejected}
+
+@router.put("/populate_fact_push_notification")
+async def populate_fact_push_notification(request: Request, file: UploadFile = File(...)):
     try:
-        # Reading the CSV file
-        data = read_csv(file)
-        
-        # Validating sent_date column
-        if 'sent_date' in data.columns and not all(data['sent_date'].apply(validate_sent_date)):
-            raise HTTPException(status_code=400, detail="Invalid or missing values in the sent_date column.")
-        
-        # Inserting data into FactPushNotification table
-        fact_push_notification_handler.insert_many(data)
-
-        return JSONResponse(content=jsonable_encoder({"message": "Data loaded successfully"}), status_code=200)
+        # Reading, validating and inserting the CSV file into FactPushNotification table on the writer thread
+        pool = request.app.state.pool
+        counts = await pool.write(load_csv_chunks, pool, 'FactPushNotification', file)
+
+        return JSONResponse(content=jsonable_encoder({"message": "Data loaded successfully", **counts}), status_code=200)
 
     except Exception as e:
-        logger.error(f"Failed to populate FactPushNotification: {str(e)}")
+        logger.error("Failed to populate FactPushNotification: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to populate FactPushNotification: {str(e)}")
     
-@app.put("/populate_fact_email")
-async def populate_fact_email(file: UploadFile = File(...)):
+@router.put("/populate_fact_email")
+async def populate_fact_email(request: Request, file: UploadFile = File(...)):
     try:
-        # Reading the CSV file
-        data = read_csv(file)
-        
-        # Validating sent_date column
-        if 'sent_date' in data.columns and not all(data['sent_date'].apply(validate_sent_date)):
-            raise HTTPException(status_code=400, detail="Invalid or missing values in the sent_date column.")
-        
-        # Inserting data into FactEmail table
-        fact_email_handler.insert_many(data)
-
-        return JSONResponse(content=jsonable_encoder({"message": "Data loaded successfully"}), status_code=200)
+        # Reading, validating and inserting the CSV file into FactEmail table on the writer thread
+        pool = request.app.state.pool
+        counts = await pool.write(load_csv_chunks, pool, 'FactEmail', file)
+
+        return JSONResponse(content=jsonable_encoder({"message": "Data loaded successfully", **counts}), status_code=200)
 
     except Exception as e:
-        logger.error(f"Failed to populate FactEmail: {str(e)}")
+        logger.error("Failed to populate FactEmail: %s", e)
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail=f"Failed to populate FactEmail: {str(e)}")
 
     
 ## Adding endpoints for different scenarios
 
-@app.get("/get_top_churn_clv_customers")
-async def get_top_churn_clv_customers(
-    pred_period: int = Query(..., description="Prediction period (1-12)"),
-    top_percentage: int = Query(10, description="Top percentage of customers to select (e.g., 10 for top 10%)", ge=1, le=100)
-):
+# The number of customers fetched and encoded at a time when a ranking is streamed
+STREAM_CHUNKSIZE = 10000
+# The largest page of a paginated JSON response
+MAX_PAGE_SIZE = 100000
+
+LIMIT_DESCRIPTION = "Page size: return at most this many customers and the next_cursor of the following page (JSON format only)"
+CURSOR_DESCRIPTION = "The next_cursor of the previous page, to continue from where it ended"
+FORMAT_DESCRIPTION = "json, or ndjson / csv / arrow to stream the whole selection (from the cursor on) chunk by chunk"
+FORMAT_PATTERN = f"^(json|{'|'.join(STREAMING_FORMATS)})$"
+
+def ranking_version(state) -> tuple:
+    """
+    Returns the version of the data the ranking endpoints are computed from.
+
+    Parameters:
+    - state (State): The state of the app.
+
+    Returns:
+    - tuple: The data version of FactPredictions and the version of the snapshot (None without a snapshot).
+    """
+    snapshot_version = state.snapshot.current_version() if state.snapshot is not None else None
+    return data_version(state.pool.dbname, 'FactPredictions'), snapshot_version
+
+async def cached_response(request: Request, key: tuple, compute) -> Response:
+    """
+    Returns the response of a ranking endpoint from the response cache, computing it only when the data has changed.
+    The response carries an ETag, and a 304 without a body is returned when it matches the If-None-Match header.
+
+    Parameters:
+    - request (Request): The request.
+    - key (tuple): The endpoint and its parameters.
+    - compute (callable): An async function returning the JSON-serializable response body.
+
+    Returns:
+    - Response: The JSON response, or a 304 response.
+    """
+    response_cache = request.app.state.response_cache
+    if response_cache is None:
+        response_cache = ResponseCache(max_entries=0)
+
+    # The version is read before the data, so an entry can never be newer than its version says
+    version = ranking_version(request.app.state)
+    entry = response_cache.get(key, version)
+    if entry is None:
+        entry = response_cache.put(key, version, await compute())
+
+    headers = {'ETag': entry.etag, 'Cache-Control': 'no-cache'}
+    if etag_matches(request.headers.get('if-none-match'), entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type='application/json', headers=headers)
+
+class Ranking(NamedTuple):
+    name: str
+    key_columns: list  # The ORDER BY columns, all descending, the last one is unique within a period
+    columns: list  # The columns returned
+
+CHURN_CLV_RANKING = Ranking('churn_clv', ['Churn_Rate', 'CLV', 'customer_ID'], ['pred_period', 'customer_ID', 'Churn_Rate', 'CLV'])
+CLV_RANKING = Ranking('clv', ['CLV', 'customer_ID'], ['customer_ID', 'pred_period'])
+
+class Cursor(NamedTuple):
+    rank: int  # The number of selected customers already returned
+    top_count: int  # The number of customers in the selection, counted by the first page (None in snapshot mode)
+    key: tuple  # The ranking key of the last customer returned
+
+def encode_cursor(cursor: Cursor) -> str:
+    """
+    Encodes a pagination cursor as an opaque URL-safe string.
+
+    Parameters:
+    - cursor (Cursor): The cursor.
+
+    Returns:
+    - str: The encoded cursor, None if cursor is None.
+    """
+    if cursor is None:
+        return None
+    payload = [cursor.rank, cursor.top_count, list(cursor.key)]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+def decode_cursor(value: str, ranking: Ranking) -> Cursor:
+    """
+    Decodes a pagination cursor returned by encode_cursor.
+
+    Parameters:
+    - value (str): The encoded cursor.
+    - ranking (Ranking): The ranking the cursor belongs to.
+
+    Returns:
+    - Cursor: The decoded cursor.
+
+    Raises:
+    - HTTPException: 400 if the cursor is not valid for the ranking.
+    """
     try:
-        handler = fact_predictions_handler
-
-        # Calling the from_sql_to_pandas function to get the data for FactPredictions
-        fact_data = handler.from_sql_to_pandas(chunksize=1000, id_value='customer_ID')
+        rank, top_count, key = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+        cursor = Cursor(int(rank), None if top_count is None else int(top_count), tuple(key))
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from e
+    # Only the last key (customer_ID) cannot be NULL
+    if cursor.rank < 0 or (cursor.top_count is not None and cursor.top_count < cursor.rank) or \
+            len(cursor.key) != len(ranking.key_columns) or \
+            not all(item is None or isinstance(item, (int, float)) for item in cursor.key) or cursor.key[-1] is None:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return cursor
+
+def keyset_conditions(key_columns: list, key: tuple) -> list:
+    """
+    Builds the conditions selecting the rows that come after a key in the descending order of key_columns,
+    in which SQLite sorts NULL last.
+
+    A row value comparison such as (Churn_Rate, CLV, customer_ID) < (?, ?, ?) is NULL, hence false, for the rows
+    with a NULL in a compared column, so the rows with NULL keys are selected by conditions of their own.
+    Each condition can be answered by a seek in the index of the ranking.
+
+    Parameters:
+    - key_columns (list): The descending ORDER BY columns, the last one being unique and never NULL.
+    - key (tuple): The ranking key of the last row returned, None for NULL.
+
+    Returns:
+    - list: The (condition, params) pairs, whose rows together are the rows after the key (in no particular order).
+    """
+    conditions = []
+    prefix, prefix_params = [], []
+    for i, (column, value) in enumerate(zip(key_columns, key)):
+        if value is None:
+            # Nothing sorts after NULL, the rows after the key have a NULL here too
+            prefix.append(f'{column} IS NULL')
+            continue
+        if all(item is not None for item in key[i:]):
+            # One row value comparison covers the rest of the non-NULL rows, and each column but the last
+            # gets a condition for its NULLs, which sort after the other rows with the same preceding columns
+            rest = key_columns[i:]
+            conditions.append((prefix + [f"({', '.join(rest)}) < ({', '.join('?' for _ in rest)})"],
+                               prefix_params + list(key[i:])))
+            for j in range(i, len(key_columns) - 1):
+                conditions.append((prefix + [f'{col} = ?' for col in key_columns[i:j]] + [f'{key_columns[j]} IS NULL'],
+                                   prefix_params + list(key[i:j])))
+            break
+        conditions.append((prefix + [f'{column} < ?'], prefix_params + [value]))
+        conditions.append((prefix + [f'{column} IS NULL'], list(prefix_params)))
+        prefix.append(f'{column} = ?')
+        prefix_params.append(value)
+    return [(' AND '.join(condition), tuple(params)) for condition, params in conditions]
+
+def select_ranking(pool: ConnectionPool, snapshot: PredictionSnapshot, ranking: Ranking, pred_period: int,
+                   top_percentage: int, cursor: Cursor = None, limit: int = None) -> tuple:
+    """
+    Selects the top percentage of customers of a prediction period according to a ranking, or one page of them.
+    Meant to be run on a reader thread of the pool.
+
+    Parameters:
+    - pool (ConnectionPool): The connection pool of the app.
+    - snapshot (PredictionSnapshot): The snapshot of FactPredictions, or None to query the database.
+    - ranking (Ranking): CHURN_CLV_RANKING or CLV_RANKING.
+    - pred_period (int): The prediction period.
+    - top_percentage (int): The percentage of customers to select.
+    - cursor (Cursor): Where the previous page ended, None to start from the top.
+    - limit (int): The maximum number of customers to return, None for the whole (rest of the) selection.
+
+    Returns:
+    - tuple: The DataFrame of the customers (with the ranking's columns), and the cursor of the next page
+      (None when the selection is exhausted).
+    """
+    rank = cursor.rank if cursor is not None else 0
+    top_count = cursor.top_count if cursor is not None else None
+    # One more customer than the page size is fetched to know whether there is a next page
+    fetch = None if limit is None else limit + 1
+
+    if snapshot is not None:
+        select = snapshot.top_churn_clv if ranking is CHURN_CLV_RANKING else snapshot.top_clv
+        customers = select(pred_period, top_percentage, offset=rank, limit=fetch)
+    else:
+        handler = pool.handler('FactPredictions')
+
+        # Calculating the number of customers to select based on the specified top percentage. The count scans
+        # the period, so it is only done for the first page and carried by the cursors of the next ones
+        if top_count is None:
+            total_customers = handler.count_rows(where='pred_period = ?', params=(pred_period,))
+            top_count = int(top_percentage / 100 * total_customers)
+        count = top_count - rank if fetch is None else min(fetch, top_count - rank)
+
+        # Continuing after the last customer returned: the index seeks to it instead of skipping the previous pages
+        conditions = keyset_conditions(ranking.key_columns, cursor.key) if cursor is not None else [('', ())]
+
+        # The sorting is served by the (pred_period, Churn_Rate, CLV, customer_ID) and (pred_period, CLV, customer_ID) indexes
+        pages = [handler.select_top(
+            order_by=', '.join(f'{col} DESC' for col in ranking.key_columns),
+            limit=max(count, 0),
+            columns=ranking.columns + [col for col in ranking.key_columns if col not in ranking.columns],
+            where='pred_period = ?' + (f' AND {condition}' if condition else ''),
+            params=(pred_period,) + params,
+        ) for condition, params in conditions]
+        customers = pages[0]
+        if len(pages) > 1:
+            # Merging the rows of the conditions in the ranking order, with NULL last as in SQLite.
+            # The keys are cast to float, as a page of NULL keys is read as a column of None
+            numeric_keys = {col: float for col in ranking.key_columns[:-1]}
+            customers = pd.concat([page.astype(numeric_keys) for page in pages if not page.empty] or pages[:1],
+                                  ignore_index=True)
+            customers = customers.sort_values(ranking.key_columns, ascending=False, na_position='last').iloc[:max(count, 0)]
+
+    next_cursor = None
+    if limit is not None and len(customers) > limit:
+        customers = customers.iloc[:limit]
+        last = [customers[col].iat[-1] for col in ranking.key_columns]
+        next_cursor = Cursor(rank + limit, top_count, tuple(None if pd.isna(value) else value.item() for value in last))
+    return customers[ranking.columns], next_cursor
+
+def encode_ranking_chunk(pool: ConnectionPool, snapshot: PredictionSnapshot, ranking: Ranking, pred_period: int,
+                         top_percentage: int, cursor: Cursor, encoder: Encoder) -> tuple:
+    # Selecting and encoding the next chunk of a streamed ranking, both on a reader thread
+    customers, next_cursor = select_ranking(pool, snapshot, ranking, pred_period, top_percentage, cursor, STREAM_CHUNKSIZE)
+    return encoder.encode(customers), next_cursor
+
+async def stream_ranking(state, ranking: Ranking, pred_period: int, top_percentage: int, cursor: Cursor,
+                         encoder: Encoder):
+    """
+    Generates a ranking encoded chunk by chunk, each chunk being fetched from where the previous one ended.
+    The selection is counted by the first chunk only, the next ones get the count from the cursor.
+
+    Parameters:
+    - state (State): The state of the app.
+    - ranking (Ranking): CHURN_CLV_RANKING or CLV_RANKING.
+    - pred_period (int): The prediction period.
+    - top_percentage (int): The percentage of customers to select.
+    - cursor (Cursor): Where to start, None to start from the top.
+    - encoder (Encoder): The encoder of the output format.
+
+    Yields:
+    - bytes: The encoded chunks.
+    """
+    try:
+        while True:
+            data, cursor = await state.pool.read(encode_ranking_chunk, state.pool, state.snapshot, ranking,
+                                                 pred_period, top_percentage, cursor, encoder)
+            yield data
+            if cursor is None:
+                break
+        yield encoder.close()
+    except Exception as e:
+        # The status has already been sent, the client sees a truncated stream
+        logger.error("Failed to stream the %s ranking: %s", ranking.name, e)
+        raise
 
-        # Filtering the data for the specified prediction period
-        selected_data = fact_data[fact_data['pred_period'] == pred_period]
+def streaming_ranking_response(state, ranking: Ranking, pred_period: int, top_percentage: int, cursor: Cursor,
+                               output_format: str) -> StreamingResponse:
+    try:
+        encoder = get_encoder(output_format)
+    except ImportError:
+        raise HTTPException(status_code=501, detail=f"The {output_format} format requires the optional pyarrow package")
+    return StreamingResponse(stream_ranking(state, ranking, pred_period, top_percentage, cursor, encoder),
+                             media_type=encoder.media_type)
 
-        # Sorting the data first by Churn_Rate and then by CLV in descending order
-        sorted_data = selected_data.sort_values(by=['Churn_Rate', 'CLV'], ascending=[False, False])
+@router.get("/get_top_churn_clv_customers")
+async def get_top_churn_clv_customers(
+    request: Request,
+    pred_period: int = Query(..., description="Prediction period (1-12)"),
+    top_percentage: int = Query(10, description="Top percentage of customers to select (e.g., 10 for top 10%)", ge=1, le=100),
+    limit: Optional[int] = Query(None, description=LIMIT_DESCRIPTION, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, description=CURSOR_DESCRIPTION),
+    output_format: str = Query('json', alias='format', description=FORMAT_DESCRIPTION, pattern=FORMAT_PATTERN)
+):
+    state = request.app.state
+    page_cursor = decode_cursor(cursor, CHURN_CLV_RANKING) if cursor else None
+    if output_format != 'json':
+        return streaming_ranking_response(state, CHURN_CLV_RANKING, pred_period, top_percentage, page_cursor, output_format)
 
-        # Calculating the number of customers to select based on the specified top percentage
-        total_customers = len(sorted_data)
-        top_count = int(top_percentage / 100 * total_customers)
+    try:
+        async def compute():
+            top_churn_customers, next_cursor = await state.pool.read(
+                select_ranking, state.pool, state.snapshot, CHURN_CLV_RANKING, pred_period, top_percentage, page_cursor, limit)
 
-        # Selecting the top percentage of customers with the highest churn rate and then CLV
-        top_churn_customers = sorted_data.head(top_count)
+            if limit is not None or page_cursor is not None:
+                return {"customers": top_churn_customers.to_dict(orient='records'), "next_cursor": encode_cursor(next_cursor)}
 
-        if top_churn_customers.empty:
-            return {"message": "No customers found"}
+            if top_churn_customers.empty:
+                return {"message": "No customers found"}
 
-        # Returning pred_period, customer_id, churn_rate, and clv without merging
-        result_data = top_churn_customers[['pred_period', 'customer_ID', 'Churn_Rate', 'CLV']].to_dict(orient='records')
+            # Returning pred_period, customer_id, churn_rate, and clv without merging
+            return top_churn_customers[['pred_period', 'customer_ID', 'Churn_Rate', 'CLV']].to_dict(orient='records')
 
-        return result_data
+        return await cached_response(request, ('get_top_churn_clv_customers', pred_period, top_percentage, limit, cursor), compute)
     except Exception as e:
-        logger.error(f"Failed to get top churn customers: {str(e)}")
+        logger.error("Failed to get top churn customers: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to get top churn customers: {str(e)}")
 
 
-@app.get("/get_top_clv_customers")
+@router.get("/get_top_clv_customers")
 async def get_top_clv_customers(
+    request: Request,
     top_percentage: int = Query(..., description="Percentage of customers to select (e.g., 20 for top 20%)", ge=1, le=100),
-    pred_period: int = Query(12, description="Prediction period (1-12)")
+    pred_period: int = Query(12, description="Prediction period (1-12)"),
+    limit: Optional[int] = Query(None, description=LIMIT_DESCRIPTION, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, description=CURSOR_DESCRIPTION),
+    output_format: str = Query('json', alias='format', description=FORMAT_DESCRIPTION, pattern=FORMAT_PATTERN)
 ):
-    try:
-        handler = fact_predictions_handler
-
-        # Calling the from_sql_to_pandas function to get the data for FactPredictions
-        fact_data = handler.from_sql_to_pandas(chunksize=1000, id_value='customer_ID')
+    state = request.app.state
+    page_cursor = decode_cursor(cursor, CLV_RANKING) if cursor else None
+    if output_format != 'json':
+        return streaming_ranking_response(state, CLV_RANKING, pred_period, top_percentage, page_cursor, output_format)
 
-        # Filtering the data for the specified prediction period
-        selected_data = fact_data[fact_data['pred_period'] == pred_period]
-
-        # Sorting the data by CLV in descending order
-        sorted_data = selected_data.sort_values(by='CLV', ascending=False)
-
-        # Calculating the number of customers to select based on the specified top percentage
-        total_customers = len(sorted_data)
-        selected_count = int(top_percentage / 100 * total_customers)
+    try:
+        async def compute():
+            selected_customers, next_cursor = await state.pool.read(
+                select_ranking, state.pool, state.snapshot, CLV_RANKING, pred_period, top_percentage, page_cursor, limit)
 
-        # Selecting the top percentage of customers
-        selected_customers = sorted_data.head(selected_count)
+            if limit is not None or page_cursor is not None:
+                return {"selected_customers": selected_customers.to_dict(orient='records'),
+                        "next_cursor": encode_cursor(next_cursor)}
 
-        if selected_customers.empty:
-            return {"message": "No customers found"}
+            if selected_customers.empty:
+                return {"message": "No customers found"}
 
-        # Returning only customer_id and pred_period without merging
-        result_data = selected_customers[['customer_ID', 'pred_period']].to_dict(orient='records')
+            # Returning only customer_id and pred_period without merging
+            result_data = selected_customers[['customer_ID', 'pred_period']].to_dict(orient='records')
+            return {"selected_customers": result_data}
 
-        return {"selected_customers": result_data}
+        return await cached_response(request, ('get_top_clv_customers', pred_period, top_percentage, limit, cursor), compute)
     except Exception as e:
-        logger.error(f"Failed to get top CLV customers: {str(e)}")
+        logger.error("Failed to get top CLV customers: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to get top CLV customers: {str(e)}")
 
 
@@ -0,0 +1,153 @@
+"""
+Module: cache.py
+
+This module defines a class called 'ResponseCache', a bounded in-process LRU cache of serialized API responses.
+
+Every entry is stored together with the data version it was computed from (e.g. the data version of FactPredictions,
+see SqlHandler.data_version, and the version of the prediction snapshot). An entry is only returned while the version
+is unchanged, so a write to the database, by any process, invalidates the cached rankings without having to find
+and delete them.
+
+The ETag of a response is a hash of its body, so it is the same in every worker process and after a restart,
+and a client sending it back in If-None-Match gets a 304 while the data has not changed.
+
+Methods:
+
+- get(self, key: tuple, version: tuple) -> CachedResponse:
+    Returns the cached response of a key if it was computed from the given data version, or None.
+
+- put(self, key: tuple, version: tuple, content: Any) -> CachedResponse:
+    Serializes a response body and caches it under a key and a data version.
+
+- clear(self) -> None:
+    Removes every entry.
+
+- stats(self) -> dict:
+    Returns the size and the hit / miss counters of the cache.
+
+- etag_matches(if_none_match: str, etag: str) -> bool:
+    Checks whether an If-None-Match header matches an ETag.
+
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, NamedTuple
+from fastapi.responses import JSONResponse
+from ..logger import CustomFormatter, get_log_level
+
+# Initialize and configure the logger
+logger = logging.getLogger(os.path.basename(__file__))
+logger.setLevel(get_log_level(logger.name))
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(CustomFormatter())
+logger.addHandler(ch)
+
+
+class CachedResponse(NamedTuple):
+    version: tuple
+    body: bytes
+    etag: str
+    created: float
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Checks whether an If-None-Match header matches an ETag (weak comparison, as required for If-None-Match).
+
+    Parameters:
+    - if_none_match (str): The value of the If-None-Match header, possibly None.
+    - etag (str): The ETag of the current response.
+
+    Returns:
+    - bool: True if the client already has the current response.
+    """
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in candidates or etag.removeprefix('W/') in {tag.removeprefix('W/') for tag in candidates}
+
+
+class ResponseCache:
+
+    def __init__(self, max_entries: int = 256, ttl: float = None) -> None:
+        """
+        Constructor for the ResponseCache class.
+
+        Parameters:
+        - max_entries (int): The maximum number of cached responses, the least recently used ones are evicted above it.
+        - ttl (float): The maximum age in seconds of an entry, None to keep entries until the data version changes.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key: tuple, version: tuple) -> CachedResponse:
+        """
+        Returns the cached response of a key if it was computed from the given data version.
+
+        Parameters:
+        - key (tuple): The key of the response (e.g. the endpoint and its parameters).
+        - version (tuple): The current data version.
+
+        Returns:
+        - CachedResponse: The cached response, or None if there is none for this version.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.version != version or (
+                    self.ttl is not None and time.monotonic() - entry.created > self.ttl):
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry
+
+    def put(self, key: tuple, version: tuple, content: Any) -> CachedResponse:
+        """
+        Serializes a response body as FastAPI does for a JSONResponse and caches it under a key and a data version.
+        The version must have been read before the data the content was computed from.
+
+        Parameters:
+        - key (tuple): The key of the response (e.g. the endpoint and its parameters).
+        - version (tuple): The data version the content was computed from.
+        - content (Any): The JSON-serializable response body.
+
+        Returns:
+        - CachedResponse: The cached response.
+        """
+        body = JSONResponse(content=content).body
+        entry = CachedResponse(version, body, f'"{hashlib.sha256(body).hexdigest()[:32]}"', time.monotonic())
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self) -> None:
+        """
+        Removes every entry.
+        """
+        with self._lock:
+            self._entries.clear()
+        logger.info('The response cache has been cleared')
+
+    def stats(self) -> dict:
+        """
+        Returns the size and the hit / miss counters of the cache.
+
+        Returns:
+        - dict: entries, max_entries, hits and misses.
+        """
+        with self._lock:
+            return {'entries': len(self._entries), 'max_entries': self.max_entries,
+                    'hits': self._hits, 'misses': self._misses}
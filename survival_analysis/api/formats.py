@@ -0,0 +1,111 @@
+"""
+Module: formats.py
+
+This module defines the encoders of the streaming output formats of the ranking endpoints.
+An encoder turns the DataFrame chunks of a selection into bytes one chunk at a time, so a response of any size
+is sent without the whole selection being held in memory or serialized at once.
+
+Formats:
+- ndjson: one JSON object per line (application/x-ndjson).
+- csv: a header line followed by the rows (text/csv).
+- arrow: an Arrow IPC stream (application/vnd.apache.arrow.stream), requires the optional pyarrow package.
+
+Methods:
+
+- get_encoder(output_format: str) -> Encoder:
+    Returns a new encoder for a format.
+
+- Encoder.encode(self, chunk: pd.DataFrame) -> bytes:
+    Encodes one chunk of the selection.
+
+- Encoder.close(self) -> bytes:
+    Returns the bytes ending the stream.
+
+"""
+
+import io
+import json
+from abc import ABC, abstractmethod
+import pandas as pd
+
+STREAMING_FORMATS = ('ndjson', 'csv', 'arrow')
+
+
+class Encoder(ABC):
+    media_type = 'application/octet-stream'
+
+    @abstractmethod
+    def encode(self, chunk: pd.DataFrame) -> bytes:
+        pass
+
+    def close(self) -> bytes:
+        return b''
+
+
+class NDJSONEncoder(Encoder):
+    media_type = 'application/x-ndjson'
+
+    def encode(self, chunk: pd.DataFrame) -> bytes:
+        # json.dumps keeps the full float precision, as the JSON responses do
+        return ''.join(json.dumps(record) + '\n' for record in chunk.to_dict(orient='records')).encode()
+
+
+class CSVEncoder(Encoder):
+    media_type = 'text/csv'
+
+    def __init__(self) -> None:
+        self._header = True
+
+    def encode(self, chunk: pd.DataFrame) -> bytes:
+        data = chunk.to_csv(index=False, header=self._header)
+        self._header = False
+        return data.encode()
+
+
+class ArrowEncoder(Encoder):
+    media_type = 'application/vnd.apache.arrow.stream'
+
+    def __init__(self) -> None:
+        import pyarrow
+        self._pa = pyarrow
+        self._sink = io.BytesIO()
+        self._writer = None
+
+    def _drain(self) -> bytes:
+        data = self._sink.getvalue()
+        self._sink.seek(0)
+        self._sink.truncate()
+        return data
+
+    def encode(self, chunk: pd.DataFrame) -> bytes:
+        batch = self._pa.RecordBatch.from_pandas(chunk, preserve_index=False)
+        if self._writer is None:
+            # The schema message is written once, before the first batch
+            self._writer = self._pa.ipc.new_stream(self._sink, batch.schema)
+        self._writer.write_batch(batch)
+        return self._drain()
+
+    def close(self) -> bytes:
+        if self._writer is not None:
+            self._writer.close()
+        return self._drain()
+
+
+def get_encoder(output_format: str) -> Encoder:
+    """
+    Returns a new encoder for a streaming output format.
+
+    Parameters:
+    - output_format (str): 'ndjson', 'csv' or 'arrow'.
+
+    Returns:
+    - Encoder: The encoder of the format.
+
+    Raises:
+    - ValueError: If the format is unknown.
+    - ImportError: If the format is 'arrow' and pyarrow is not installed.
+    """
+    encoders = {'ndjson': NDJSONEncoder, 'csv': CSVEncoder, 'arrow': ArrowEncoder}
+    if output_format not in encoders:
+        raise ValueError(f'Unknown output format: {output_format}')
+    return encoders[output_format]()
@@ -0,0 +1,211 @@
+"""
+Module: snapshot.py
+
+This module builds and reads a read-only snapshot of the FactPredictions table, stored as NumPy arrays on disk.
+API worker processes memory-map the same files, so they answer the ranking endpoints from shared pages
+without each holding its own copy of the table and without querying SQLite.
+
+Layout of a snapshot directory:
+- <snapshot_dir>/<version>/*.npy: the arrays of one snapshot.
+- <snapshot_dir>/CURRENT: the name of the current version, replaced atomically by build_snapshot.
+
+The arrays are sorted by pred_period and then by Churn_Rate, CLV and customer_ID in descending order (the order of
+/get_top_churn_clv_customers), 'offsets' gives the first row of each period and 'clv_order' the row order of
+/get_top_clv_customers (CLV and customer_ID descending) within each period.
+
+Methods:
+
+- build_snapshot(dbname: str, snapshot_dir: str, chunksize: int, keep: int) -> str:
+    Writes a new snapshot of FactPredictions and makes it the current one.
+
+- PredictionSnapshot.current_version(self) -> str:
+    Returns the version of the current snapshot.
+
+- PredictionSnapshot.top_churn_clv(self, pred_period: int, top_percentage: int, offset: int, limit: int) -> pd.DataFrame:
+    Selects the top percentage of customers of a period by churn rate and then CLV.
+
+- PredictionSnapshot.top_clv(self, pred_period: int, top_percentage: int, offset: int, limit: int) -> pd.DataFrame:
+    Selects the top percentage of customers of a period by CLV.
+
+"""
+
+import logging
+import os
+import shutil
+import threading
+import time
+import numpy as np
+import pandas as pd
+from ..logger import CustomFormatter, get_log_level
+from ..database_preparation import SqlHandler
+
+# Initialize and configure the logger
+logger = logging.getLogger(os.path.basename(__file__))
+logger.setLevel(get_log_level(logger.name))
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(CustomFormatter())
+logger.addHandler(ch)
+
+CURRENT_FILE = 'CURRENT'
+ARRAYS = ['customer_id', 'pred_period', 'churn_rate', 'clv', 'periods', 'offsets', 'clv_order']
+
+
+def _descending_key(values: np.ndarray) -> np.ndarray:
+    # Sorting ascending on the negated values gives a descending order, with missing values last as in SQLite
+    return np.where(np.isnan(values), np.inf, -values)
+
+
+def build_snapshot(dbname: str = 'sa_db', snapshot_dir: str = 'prediction_snapshot',
+                   chunksize: int = 100000, keep: int = 2) -> str:
+    """
+    Writes a new snapshot of FactPredictions and makes it the current one.
+
+    The arrays are written to a new version directory first and CURRENT is then replaced atomically,
+    so readers see either the previous snapshot or the new one, never a partial one.
+
+    Parameters:
+    - dbname (str): The name of the SQLite database.
+    - snapshot_dir (str): The directory of the snapshots.
+    - chunksize (int): The number of rows read from the database at a time.
+    - keep (int): The number of snapshot versions kept on disk (the older ones are deleted).
+
+    Returns:
+    - str: The path of the new snapshot version.
+    """
+    handler = SqlHandler(dbname, 'FactPredictions')
+    chunks = list(handler.iter_chunks(chunksize, 'rowid', columns=['customer_ID', 'pred_period', 'Churn_Rate', 'CLV']))
+    handler.close_cnxn()
+    data = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(
+        {'customer_ID': [], 'pred_period': [], 'Churn_Rate': [], 'CLV': []})
+
+    customer_id = data['customer_ID'].to_numpy(dtype=np.int64)
+    pred_period = data['pred_period'].to_numpy(dtype=np.int64)
+    churn_rate = data['Churn_Rate'].to_numpy(dtype=np.float64)
+    clv = data['CLV'].to_numpy(dtype=np.float64)
+    del data, chunks
+
+    # np.lexsort sorts by the last key first
+    order = np.lexsort((-customer_id, _descending_key(clv), _descending_key(churn_rate), pred_period))
+    customer_id, pred_period, churn_rate, clv = customer_id[order], pred_period[order], churn_rate[order], clv[order]
+
+    periods, starts = np.unique(pred_period, return_index=True)
+    offsets = np.append(starts, len(pred_period)).astype(np.int64)
+    clv_order = np.lexsort((-customer_id, _descending_key(clv), pred_period)).astype(np.int64)
+
+    version = str(time.time_ns())
+    path = os.path.join(snapshot_dir, version)
+    os.makedirs(path)
+    arrays = {'customer_id': customer_id, 'pred_period': pred_period, 'churn_rate': churn_rate, 'clv': clv,
+              'periods': periods, 'offsets': offsets, 'clv_order': clv_order}
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f'{name}.npy'), array)
+
+    # Swapping the current version atomically
+    tmp_current = os.path.join(snapshot_dir, f'{CURRENT_FILE}.tmp')
+    with open(tmp_current, 'w') as f:
+        f.write(version)
+    os.replace(tmp_current, os.path.join(snapshot_dir, CURRENT_FILE))
+    logger.warning('Prediction snapshot %s is built: %d rows', version, len(customer_id))
+
+    # Workers still mapping a deleted version keep their pages until they switch to the new one
+    versions = sorted(name for name in os.listdir(snapshot_dir) if name.isdigit())
+    for old_version in versions[:-keep]:
+        shutil.rmtree(os.path.join(snapshot_dir, old_version), ignore_errors=True)
+    return path
+
+
+class PredictionSnapshot:
+    """
+    A read-only, memory-mapped view of the current FactPredictions snapshot.
+    The snapshot is reopened automatically when build_snapshot swaps in a new version.
+
+    Parameters:
+    - snapshot_dir (str): The directory of the snapshots.
+    """
+
+    def __init__(self, snapshot_dir: str = 'prediction_snapshot') -> None:
+        self.snapshot_dir = snapshot_dir
+        self.version = None
+        self._arrays = None
+        self._current_mtime = None
+        self._lock = threading.Lock()
+
+    def _current(self) -> dict:
+        current_path = os.path.join(self.snapshot_dir, CURRENT_FILE)
+        # A stat per request is enough to notice a swap, CURRENT is only read when it changed
+        mtime = os.stat(current_path).st_mtime_ns
+        if mtime != self._current_mtime:
+            with self._lock:
+                if mtime != self._current_mtime:
+                    with open(current_path) as f:
+                        version = f.read().strip()
+                    path = os.path.join(self.snapshot_dir, version)
+                    self._arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in ARRAYS}
+                    self.version = version
+                    self._current_mtime = mtime
+                    logger.info('Prediction snapshot %s is mapped', version)
+        return self._arrays
+
+    def current_version(self) -> str:
+        """
+        Returns the version of the current snapshot, mapping it first if it has been swapped.
+
+        Returns:
+        - str: The version of the current snapshot.
+        """
+        self._current()
+        return self.version
+
+    def _period_rows(self, arrays: dict, pred_period: int, top_percentage: int, offset: int, limit: int) -> slice:
+        # Locating the rows of the period, then the part of the selection from offset to offset + limit
+        position = np.searchsorted(arrays['periods'], pred_period)
+        if position == len(arrays['periods']) or arrays['periods'][position] != pred_period:
+            return slice(0, 0)
+        start, end = int(arrays['offsets'][position]), int(arrays['offsets'][position + 1])
+        count = int(top_percentage / 100 * (end - start))
+        stop = count if limit is None else min(count, offset + limit)
+        return slice(start + min(offset, count), start + stop)
+
+    def top_churn_clv(self, pred_period: int, top_percentage: int, offset: int = 0, limit: int = None) -> pd.DataFrame:
+        """
+        Selects the top percentage of customers of a period by churn rate and then CLV.
+
+        Parameters:
+        - pred_period (int): The prediction period.
+        - top_percentage (int): The percentage of customers to select.
+        - offset (int): The number of selected customers to skip (for pagination).
+        - limit (int): The maximum number of customers to return, None for all.
+
+        Returns:
+        - pd.DataFrame: The pred_period, customer_ID, Churn_Rate and CLV of the selected customers.
+        """
+        arrays = self._current()
+        rows = self._period_rows(arrays, pred_period, top_percentage, offset, limit)
+        return pd.DataFrame({
+            'pred_period': arrays['pred_period'][rows],
+            'customer_ID': arrays['customer_id'][rows],
+            'Churn_Rate': arrays['churn_rate'][rows],
+            'CLV': arrays['clv'][rows],
+        })
+
+    def top_clv(self, pred_period: int, top_percentage: int, offset: int = 0, limit: int = None) -> pd.DataFrame:
+        """
+        Selects the top percentage of customers of a period by CLV.
+
+        Parameters:
+        - pred_period (int): The prediction period.
+        - top_percentage (int): The percentage of customers to select.
+        - offset (int): The number of selected customers to skip (for pagination).
+        - limit (int): The maximum number of customers to return, None for all.
+
+        Returns:
+        - pd.DataFrame: The customer_ID, pred_period and CLV of the selected customers.
+        """
+        arrays = self._current()
+        rows = arrays['clv_order'][self._period_rows(arrays, pred_period, top_percentage, offset, limit)]
+        return pd.DataFrame({
+            'customer_ID': arrays['customer_id'][rows],
+            'pred_period': arrays['pred_period'][rows],
+            'CLV': arrays['clv'][rows],
+        })
@@ -1,2 +1,10 @@
 from ..logger import CustomFormatter
-from .sql_interactions import SqlHandler
\ No newline at end of file
+from .sql_interactions import SqlHandler, data_version
+from .connection_pool import ConnectionPool
+
+def __getattr__(name):
+    # SQLAlchemy is imported only when the schema is needed
+    if name == 'create_schema':
+        from .schema import create_schema
+        return create_schema
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
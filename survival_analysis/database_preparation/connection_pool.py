@@ -0,0 +1,140 @@
+"""
+Module: connection_pool.py
+
+This module defines a class called 'ConnectionPool' which gives concurrent callers (e.g. the FastAPI app) their own
+SQLite connections and runs the blocking database work off the event loop.
+
+- Reads run on a bounded pool of threads, each thread with its own read-only connection.
+- Writes run on one dedicated writer thread with its own connection, so they are serialized.
+- The database is switched to WAL journaling, so the readers never wait on a running write.
+
+Methods:
+
+- handler(self, table_name: str) -> SqlHandler:
+    Returns a SqlHandler for a table, on the connection of the calling thread.
+
+- read(self, fn, *args) -> Any:
+    Runs fn(*args) on a reader thread and awaits its result.
+
+- write(self, fn, *args) -> Any:
+    Runs fn(*args) on the writer thread and awaits its result.
+
+- close(self) -> None:
+    Stops the threads and closes every connection of the pool.
+
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from ..logger import CustomFormatter, get_log_level
+from .sql_interactions import SqlHandler
+
+# Initialize and configure the logger
+logger = logging.getLogger(os.path.basename(__file__))
+logger.setLevel(get_log_level(logger.name))
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(CustomFormatter())
+logger.addHandler(ch)
+
+WRITER_THREAD_NAME = 'sa-db-writer'
+
+
+class ConnectionPool:
+
+    def __init__(self, dbname: str, max_readers: int = 8, timeout: float = 30.0) -> None:
+        """
+        Constructor for the ConnectionPool class.
+
+        Parameters:
+        - dbname (str): The name of the SQLite database.
+        - max_readers (int): The number of reader threads (and read connections).
+        - timeout (float): How many seconds a connection waits for a lock before failing.
+        """
+        self.dbname = dbname
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+        # WAL is persistent in the database file, so it is enough to switch it on once
+        cnxn = sqlite3.connect(f'{dbname}.db', timeout=timeout)
+        cnxn.execute('PRAGMA journal_mode=WAL;')
+        cnxn.close()
+
+        self._readers = ThreadPoolExecutor(max_workers=max_readers, thread_name_prefix='sa-db-reader')
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix=WRITER_THREAD_NAME)
+        logger.info('Connection pool opened on %s.db with %d readers and one writer', dbname, max_readers)
+
+    def _connection(self) -> sqlite3.Connection:
+        cnxn = getattr(self._local, 'cnxn', None)
+        if cnxn is None:
+            cnxn = sqlite3.connect(f'{self.dbname}.db', timeout=self.timeout, check_same_thread=False)
+            cnxn.execute('PRAGMA synchronous=NORMAL;')
+            if not threading.current_thread().name.startswith(WRITER_THREAD_NAME):
+                # Read connections cannot write by mistake
+                cnxn.execute('PRAGMA query_only=ON;')
+            self._local.cnxn = cnxn
+            self._local.handlers = {}
+            with self._connections_lock:
+                self._connections.append(cnxn)
+        return cnxn
+
+    def handler(self, table_name: str) -> SqlHandler:
+        """
+        Returns a SqlHandler for a table, on the connection of the calling thread.
+        Meant to be called from functions run with read() or write().
+
+        Parameters:
+        - table_name (str): The name of the table.
+
+        Returns:
+        - SqlHandler: The handler of the table for the calling thread.
+        """
+        cnxn = self._connection()
+        handler = self._local.handlers.get(table_name)
+        if handler is None:
+            handler = SqlHandler(self.dbname, table_name, cnxn=cnxn)
+            self._local.handlers[table_name] = handler
+        return handler
+
+    async def read(self, fn, *args):
+        """
+        Runs fn(*args) on a reader thread and awaits its result.
+
+        Parameters:
+        - fn (callable): A blocking function which reads through handler().
+
+        Returns:
+        - Any: The result of fn.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._readers, partial(fn, *args))
+
+    async def write(self, fn, *args):
+        """
+        Runs fn(*args) on the writer thread and awaits its result.
+
+        Parameters:
+        - fn (callable): A blocking function which writes through handler().
+
+        Returns:
+        - Any: The result of fn.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._writer, partial(fn, *args))
+
+    def close(self) -> None:
+        """
+        Stops the threads and closes every connection of the pool.
+        """
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        with self._connections_lock:
+            for cnxn in self._connections:
+                cnxn.close()
+            self._connections.clear()
+        logger.info('The connection pool has been closed')
@@ -2,7 +2,8 @@
 Module: schema.py
 
 This module contains Python code for defining and creating a database schema using SQLAlchemy. 
-It defines four tables: 'DimCustomer', 'FactPredictions' 'FactPushNotification' and 'FactEmail'.
+It defines five tables: 'DimCustomer', 'DimCustomerHash', 'FactPredictions' 'FactPushNotification' and 'FactEmail'.
+The tables are created by calling create_schema(url), importing the module has no side effects.
 
 It also configures a custom logger for informational messages regarding the schema creation.
 
@@ -10,24 +11,21 @@ It also configures a custom logger for informational messages regarding the sche
 
 import logging
 import os
-from ..logger import CustomFormatter
+from ..logger import CustomFormatter, get_log_level
 
 # Initialize and configure the logger
 logger = logging.getLogger(os.path.basename(__file__))
-logger.setLevel(logging.DEBUG)
+logger.setLevel(get_log_level(logger.name))
 ch = logging.StreamHandler()
 ch.setLevel(logging.DEBUG)
 ch.setFormatter(CustomFormatter())
 logger.addHandler(ch)
 
-from sqlalchemy import create_engine, Column, Integer, String, Float, DATE, DateTime, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, String, Float, DATE, DateTime, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
 
-# Define and configure the database engine (Change the connection URL as needed)
-engine = create_engine('sqlite:///sa_db.db')
-
 # Create a base class for declarative class definitions
 Base = declarative_base()
 
@@ -72,6 +70,26 @@ class Customer(Base):
     Internet_Included = Column(String(3))
     Forward_Included = Column(String(3))
 
+class CustomerHash(Base):
+    """
+    Class: CustomerHash
+
+    This class defines the 'DimCustomerHash' table, which tracks the changes of 'DimCustomer' for incremental scoring.
+    It is kept apart from 'DimCustomer' so that the hashes never become covariates of the model.
+
+    Attributes:
+    - Customer_ID (int): Primary key, referencing the 'DimCustomer' table.
+    - Content_Hash (int): Hash of the customer's row and of the model, as of the last time the customer was scored.
+      A customer whose current hash differs (or who has none) is new or modified and must be scored again.
+    - customer (relationship): Establishes a relationship with the 'DimCustomer' table.
+
+    """
+    __tablename__ = "DimCustomerHash"
+
+    Customer_ID = Column(Integer, ForeignKey('DimCustomer.Customer_ID'), primary_key=True)
+    Content_Hash = Column(Integer)
+    customer = relationship("DimCustomer")
+
 class FactPredictions(Base):
     """
     Class: FactPredictions
@@ -85,8 +103,17 @@ class FactPredictions(Base):
     - Churn_Rate (float): Churn rate.
     - customer (relationship): Establishes a relationship with the 'DimCustomer' table.
 
+    Indexes:
+    - ix_FactPredictions_period_churn_clv: Covers ranking customers of one period by churn rate and then CLV.
+    - ix_FactPredictions_period_clv: Covers ranking customers of one period by CLV.
+
     """
     __tablename__ = "FactPredictions"
+    # customer_ID is the trailing column so that the ranking queries are answered from the index alone
+    __table_args__ = (
+        Index('ix_FactPredictions_period_churn_clv', 'pred_period', 'Churn_Rate', 'CLV', 'customer_ID'),
+        Index('ix_FactPredictions_period_clv', 'pred_period', 'CLV', 'customer_ID'),
+    )
 
     pred_period = Column(Integer, primary_key=True)
     customer_ID = Column(Integer, ForeignKey('DimCustomer.Customer_ID'), primary_key=True)
@@ -135,8 +162,26 @@ class FactEmail(Base):
     customer = relationship("DimCustomer")
 
 
-# Create the tables defined in the schema
-Base.metadata.create_all(engine)
+def create_schema(url: str = 'sqlite:///sa_db.db'):
+    """
+    Creates the tables defined in the schema, and their indexes, in a database.
+
+    Parameters:
+    - url (str): The connection URL of the database (Change the connection URL as needed).
+
+    Returns:
+    - sqlalchemy.engine.Engine: The engine of the database.
+    """
+    # Define and configure the database engine
+    engine = create_engine(url)
+
+    # Create the tables defined in the schema
+    Base.metadata.create_all(engine)
+
+    # create_all skips tables that already exist, so the indexes are also created for databases made before they were added
+    for index in FactPredictions.__table__.indexes:
+        index.create(engine, checkfirst=True)
 
-# Log a message indicating that the schema has been created
-logger.info("Schema Has Been Created")
+    # Log a message indicating that the schema has been created
+    logger.info("Schema Has Been Created")
+    return engine
@@ -9,17 +9,41 @@ Attributes:
 
 Methods:
 
-- __init__(self, dbname: str, table_name: str) -> None:
-    Constructor for the 'SqlHandler' class. Initializes a connection to an SQLite database and specifies the target table.
+- __init__(self, dbname: str, table_name: str, cnxn: sqlite3.Connection) -> None:
+    Constructor for the 'SqlHandler' class. Initializes (or reuses) a connection to an SQLite database and specifies the target table.
 
 - close_cnxn(self) -> None:
     Closes the SQLite database connection.
 
+- commit(self) -> None:
+    Commits the pending changes and marks the table as changed.
+
+- data_version(self) -> tuple:
+    Returns the data version of the table (see data_version below).
+
 - insert_one(self, data) -> str:
-    Inserts a single row to the database. 
+    Inserts a single row to the database (or queues it when the write buffer is enabled).
+
+- enable_write_buffer(self, max_rows: int, max_age: float) -> None:
+    Makes insert_one queue the rows and write them in batched transactions.
+
+- flush_write_buffer(self) -> int:
+    Writes the queued rows to the database in one transaction.
+
+- disable_write_buffer(self) -> None:
+    Flushes the queued rows and goes back to committing every insert_one.
+
+- write_buffer_stats(self) -> dict:
+    Returns the queue depth and flush statistics of the write buffer.
 
 - get_table_columns(self) -> list:
-    Retrieves a list of column names for the specified table.
+    Retrieves a list of column names for the specified table (cached after the first call).
+
+- get_column_types(self) -> dict:
+    Retrieves the declared type of each column of the specified table (cached after the first call).
+
+- refresh_table_columns(self) -> None:
+    Discards the cached columns and statements after the table has been altered.
 
 - truncate_table(self) -> None:
     Truncates the specified table, removing all its data.
@@ -27,57 +51,328 @@ Methods:
 - drop_table(self) -> None:
     Deletes the specified table from the database.
 
-- insert_many(self, df: pd.DataFrame) -> str:
+- insert_many(self, df: pd.DataFrame, commit: bool) -> str:
     Inserts data from a pandas DataFrame into the specified table, mapping columns to their respective database columns.
 
-- from_sql_to_pandas(self, chunksize: int, id_value: str) -> pd.DataFrame:
+- bulk_insert(self, df: pd.DataFrame, batch_size: int, synchronous: str, rebuild_indexes: bool) -> dict:
+    Inserts a large DataFrame in a single tuned transaction (WAL, batched executemany, optional index rebuild).
+
+- iter_chunks(self, chunksize: int, id_value: str, columns: list, where: str, params: tuple):
+    Retrieves data from the database as a generator of DataFrame chunks using keyset pagination.
+
+- from_sql_to_pandas(self, chunksize: int, id_value: str, columns: list, where: str, params: tuple) -> pd.DataFrame:
     Retrieves data from the database and loads it into a pandas DataFrame in chunks of a specified size.
 
+- count_rows(self, where: str, params: tuple) -> int:
+    Counts the rows of the table, optionally filtered by a condition.
+
+- select_top(self, order_by: str, limit: int, columns: list, where: str, params: tuple) -> pd.DataFrame:
+    Retrieves the first rows of the table according to an ordering, with the sorting and limiting done in SQL.
+
 - update_table(self, set_dict, cond_dict) -> str:
     Update rows in a database table based on the set and where conditions provided in dictionaries.
 
+- update_many(self, df: pd.DataFrame, key_columns: list, batch_size: int) -> int:
+    Updates many rows in a single transaction from a DataFrame of keys and new values.
+
+- upsert_many(self, df: pd.DataFrame, key_columns: list, batch_size: int, commit: bool) -> int:
+    Inserts the rows of a DataFrame, or updates the existing rows with the same keys, in a single transaction.
+
+- data_version(dbname: str, table_name: str) -> tuple:
+    Returns the data version of a table, which changes with every commit made to the database, by any process.
+
 
 """
 
 import sqlite3
 import logging
 import pandas as pd
-import numpy as np
 import os
-from ..logger import CustomFormatter
+import time
+import atexit
+import threading
+from ..logger import CustomFormatter, get_log_level
+from ..metrics import REGISTRY, timed
 
 # Initialize and configure the logger
 logger = logging.getLogger(os.path.basename(__file__))
-logger.setLevel(logging.DEBUG)
+logger.setLevel(get_log_level(logger.name))
 ch = logging.StreamHandler()
 ch.setLevel(logging.DEBUG)
 ch.setFormatter(CustomFormatter())
 logger.addHandler(ch)
 
+# Metrics of the SqlHandler methods, rendered by the API's /metrics endpoint
+SQL_SECONDS = REGISTRY.histogram('sa_sql_operation_seconds', 'Duration of the SqlHandler method calls.', ('table', 'method'))
+SQL_ERRORS = REGISTRY.counter('sa_sql_errors_total', 'SqlHandler method calls that failed.', ('table', 'method'))
+SQL_ROWS = REGISTRY.counter('sa_sql_rows_total', 'Rows written or read by the SqlHandler methods.', ('table', 'method'))
+
+def _instrumented(method):
+    # Records the duration and the failures of a SqlHandler method, labelled with the table and the method name
+    name = method.__name__
+    return timed(SQL_SECONDS, SQL_ERRORS, lambda self, *args, **kwargs: (self.table_name, name))(method)
+
+# Per-table counters of the commits made through SqlHandler in this process, keyed by (database path, table name).
+# Caches of query results (e.g. the API's response cache) compare them to notice that a table has changed.
+_data_versions = {}
+_data_versions_lock = threading.Lock()
+# Per database path, the connection used only to read PRAGMA data_version and the inode of the file it opened
+_version_connections = {}
+
+def _data_version_key(dbname: str, table_name: str) -> tuple:
+    return os.path.abspath(f'{dbname}.db'), table_name.lower()
+
+def _database_version(path: str) -> tuple:
+    # PRAGMA data_version changes whenever another connection, of this process or of another one, commits to the
+    # database, so it is read on a connection of its own that never writes. The inode tells a replaced file apart.
+    try:
+        inode = os.stat(path).st_ino
+    except FileNotFoundError:
+        return None, None
+    with _data_versions_lock:
+        entry = _version_connections.get(path)
+        if entry is None or entry[1] != inode:
+            if entry is not None:
+                entry[0].close()
+            entry = _version_connections[path] = (sqlite3.connect(path, check_same_thread=False), inode)
+        return inode, entry[0].execute('PRAGMA data_version;').fetchone()[0]
+
+def data_version(dbname: str, table_name: str) -> tuple:
+    """
+    Returns the data version of a table: the number of commits made to it through SqlHandler in this process,
+    combined with the version of the database file, which changes with every commit made to the database
+    by any other connection or process (e.g. a scoring job writing FactPredictions) and when the file is replaced.
+
+    A cached result computed while the version was v is still valid as long as the version is v,
+    provided the version was read before the data. A commit to any table of the database changes the version.
+
+    Parameters:
+    - dbname (str): The name of the SQLite database.
+    - table_name (str): The name of the table.
+
+    Returns:
+    - tuple: The data version of the table.
+    """
+    key = _data_version_key(dbname, table_name)
+    return (_data_versions.get(key, 0),) + _database_version(key[0])
+
+def _bump_data_version(dbname: str, table_name: str) -> None:
+    key = _data_version_key(dbname, table_name)
+    with _data_versions_lock:
+        _data_versions[key] = _data_versions.get(key, 0) + 1
+
+def _to_sql_values(column: pd.Series) -> list:
+    """
+    Converts a column to a list of values sqlite3 can bind, with missing values as None.
+
+    Parameters:
+    - column (pd.Series): The column to convert.
+
+    Returns:
+    - list: The values of the column as Python objects.
+    """
+    if column.dtype.kind in 'iub' and not isinstance(column.dtype, pd.api.extensions.ExtensionDtype):
+        # NumPy integer and boolean columns cannot hold missing values and tolist() already gives Python scalars,
+        # unlike the nullable Int64 / boolean columns (e.g. from normalize_fact_data), which can hold pd.NA
+        return column.tolist()
+    if column.dtype.kind == 'M':
+        column = column.dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+    if not column.hasnans:
+        return column.tolist()
+    return column.astype(object).where(column.notna(), None).tolist()
+
+
+class WriteBuffer:
+    """
+    A write-behind queue of INSERT statements, written to an SQLite database in batched transactions.
+    Used by SqlHandler.enable_write_buffer.
+
+    The buffer writes through its own connection, so a flush (e.g. from the background thread) never commits
+    or rolls back a transaction left open on the connection of the handler.
+
+    Parameters:
+    - database (str): The path of the SQLite database file the rows are written to.
+    - max_rows (int): The number of queued rows that triggers a flush.
+    - max_age (float): The age in seconds of the oldest queued row that triggers a flush.
+    - on_commit (callable): Called after every committed flush.
+    """
+
+    def __init__(self, database: str, max_rows: int, max_age: float, on_commit=None) -> None:
+        self.cnxn = sqlite3.connect(database, check_same_thread=False)
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.on_commit = on_commit
+        self._rows = []
+        self._oldest = None
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+        self._flushes = 0
+        self._flush_errors = 0
+        self._rows_flushed = 0
+        self._rows_failed = 0
+        self._last_flush_seconds = 0.0
+        self._max_flush_seconds = 0.0
+        self._thread = threading.Thread(target=self._flush_periodically, name='sqlhandler-write-buffer', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def add(self, query: str, values: list) -> None:
+        with self._lock:
+            if not self._rows:
+                self._oldest = time.monotonic()
+            self._rows.append((query, values))
+            if len(self._rows) >= self.max_rows:
+                try:
+                    self.flush()
+                except sqlite3.Error as e:
+                    # The rows stay queued and are written by a later flush
+                    logger.warning('Flush of the write buffer failed, %d rows stay queued: %s', len(self._rows), e)
+
+    def flush(self) -> int:
+        with self._lock:
+            rows, self._rows = self._rows, []
+            if not rows:
+                return 0
+            start = time.perf_counter()
+            try:
+                try:
+                    self._write(rows)
+                except sqlite3.IntegrityError as e:
+                    # One bad row should not lose the whole batch, so the rows are written one by one instead
+                    self.cnxn.rollback()
+                    logger.warning('Batched flush failed (%s), writing the %d rows one by one', e, len(rows))
+                    self._write_one_by_one(rows)
+            except sqlite3.Error:
+                # e.g. 'database is locked': nothing was written, so the rows are queued again in front of the new ones
+                self.cnxn.rollback()
+                self._rows = rows + self._rows
+                self._flush_errors += 1
+                raise
+            if self.on_commit is not None:
+                self.on_commit()
+            elapsed = time.perf_counter() - start
+            self._flushes += 1
+            self._rows_flushed += len(rows)
+            self._last_flush_seconds = elapsed
+            self._max_flush_seconds = max(self._max_flush_seconds, elapsed)
+            logger.debug('Flushed %d rows in %.4fs', len(rows), elapsed)
+            return len(rows)
+
+    def _write(self, rows: list) -> None:
+        # Consecutive rows with the same statement are sent with one executemany
+        cursor = self.cnxn.cursor()
+        start = 0
+        for end in range(1, len(rows) + 1):
+            if end == len(rows) or rows[end][0] != rows[start][0]:
+                cursor.executemany(rows[start][0], [values for _, values in rows[start:end]])
+                start = end
+        self.cnxn.commit()
+
+    def _write_one_by_one(self, rows: list) -> None:
+        # Only the rows violating a constraint are dropped, any other error aborts the whole flush
+        cursor = self.cnxn.cursor()
+        failed = 0
+        for query, values in rows:
+            try:
+                cursor.execute(query, values)
+            except sqlite3.IntegrityError as e:
+                failed += 1
+                logger.error('Dropping a buffered row %s: %s', values, e)
+        self.cnxn.commit()
+        self._rows_failed += failed
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.is_set():
+            with self._lock:
+                age = time.monotonic() - self._oldest if self._rows else 0.0
+                if self._rows and age >= self.max_age:
+                    try:
+                        self.flush()
+                    except sqlite3.Error as e:
+                        logger.warning('Flush of the write buffer failed, %d rows stay queued: %s', len(self._rows), e)
+                    age = 0.0
+            self._closed.wait(self.max_age - age)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'queue_depth': len(self._rows),
+                'flushes': self._flushes,
+                'flush_errors': self._flush_errors,
+                'rows_flushed': self._rows_flushed,
+                'rows_failed': self._rows_failed,
+                'last_flush_seconds': self._last_flush_seconds,
+                'max_flush_seconds': self._max_flush_seconds,
+            }
+
+    def close(self) -> None:
+        self._closed.set()
+        self._thread.join()
+        # If the flush fails, the rows stay queued and the exit handler tries again
+        self.flush()
+        atexit.unregister(self.flush)
+        self.cnxn.close()
+
+
 class SqlHandler:
 
-    def __init__(self, dbname: str, table_name: str) -> None:
+    def __init__(self, dbname: str, table_name: str, cnxn: sqlite3.Connection = None) -> None:
         """
         Constructor for the SqlHandler class.
 
+        The connection may be used from other threads (e.g. the API's worker threads), as long as the callers
+        do not use it from several threads at the same time.
+
         Parameters:
         - dbname (str): The name of the SQLite database.
         - table_name (str): The name of the table within the database.
+        - cnxn (sqlite3.Connection): An existing connection to use (e.g. from a ConnectionPool), a new one is opened if None.
         """
-        self.cnxn = sqlite3.connect(f'{dbname}.db')
+        self.cnxn = cnxn if cnxn is not None else sqlite3.connect(f'{dbname}.db', check_same_thread=False)
         self.cursor = self.cnxn.cursor()
         self.dbname = dbname
         self.table_name = table_name
-
+        # Column name -> declared type, loaded on first use and reset after DDL (see refresh_table_columns)
+        self._columns = None
+        self._lower_columns = None
+        # INSERT / UPDATE statements already built, keyed by their column sets
+        self._statements = {}
+        # The write-behind buffer of insert_one, see enable_write_buffer
+        self._write_buffer = None
+
+    @_instrumented
     def close_cnxn(self) -> None:
         """
         Closes the SQLite database connection.
         
         """
         logger.info('Committing the changes')
+        self.disable_write_buffer()
         self.cnxn.close()
         logger.info('The connection has been closed')
 
+    @_instrumented
+    def commit(self) -> None:
+        """
+        Commits the pending changes of the connection and marks the table as changed, so that cached results
+        of the table are invalidated (see data_version). Use it instead of cnxn.commit() after insert_many(commit=False).
+        """
+        self.cnxn.commit()
+        self._mark_changed()
+
+    def data_version(self) -> tuple:
+        """
+        Returns the data version of the table, which changes with every commit made to the database (see data_version).
+
+        Returns:
+        - tuple: The data version of the table.
+        """
+        return data_version(self.dbname, self.table_name)
+
+    def _mark_changed(self) -> None:
+        _bump_data_version(self.dbname, self.table_name)
+
+    @_instrumented
     def insert_one(self, data: dict) -> str:
         """
         Inserts a single record from a dictionary into the specified table, mapping keys to their respective database columns.
@@ -90,62 +385,178 @@ class SqlHandler:
         """
 
         #getting the DB columns
+        sql_column_names = self._sql_column_names()
 
-        columns = self.get_table_columns()
-        sql_column_names = [col.lower() for col in columns]
-
-        # Convert keys to lowercase
-        data = {key.lower(): value for key, value in data.items()}
-
-        # Filter the dictionary to keep only keys that match the database column names
-        filtered_data = {key: value for key, value in data.items() if key in sql_column_names}
+        # Convert keys to lowercase and keep only keys that match the database column names
+        filtered_data = {key.lower(): value for key, value in data.items() if key.lower() in sql_column_names}
         
         # Prepare the values to be inserted
-        row_values = list(filtered_data.values())
-        columns = list(filtered_data.keys())
-        
-        ncolumns = ['?' for _ in columns]
-        cols = ', '.join(columns)
-        params = ', '.join(ncolumns)
+        query = self._insert_query(tuple(filtered_data))
 
-        logger.info(f'Insert structure: colnames: {cols} params: {params}')
+        if self._write_buffer is not None:
+            self._write_buffer.add(query, list(filtered_data.values()))
+            return
 
-        query = f"""INSERT INTO {self.table_name} ({cols}) VALUES ({params});"""
+        self.cursor.execute(query, list(filtered_data.values()))
 
-        self.cursor.execute(query, row_values)
-    
-        try:
-            logger.info(self.cursor.messages)
-        except:
-            pass
+        self.commit()
+        logger.debug('The data is loaded')
 
-        self.cnxn.commit()
-        logger.warning('The data is loaded')
+    def enable_write_buffer(self, max_rows: int = 1000, max_age: float = 1.0) -> None:
+        """
+        Makes insert_one queue the rows instead of committing each of them, and write them in batched transactions.
+
+        The queue is flushed when it holds max_rows rows, when its oldest row is max_age seconds old
+        (by a background thread), and when the buffer is disabled, the connection is closed or the interpreter exits.
+        A crash can therefore lose at most the rows of one flush window. The rows are written through a connection
+        of their own, so the flushes do not touch the transactions of the handler. A row violating a constraint is
+        dropped (and counted in rows_failed); after any other error (e.g. 'database is locked') the rows stay queued
+        and are written by the next flush.
+
+        Parameters:
+        - max_rows (int): The number of queued rows that triggers a flush.
+        - max_age (float): The age in seconds of the oldest queued row that triggers a flush.
+        """
+        if self._write_buffer is not None:
+            self.disable_write_buffer()
+        self._write_buffer = WriteBuffer(f'{self.dbname}.db', max_rows=max_rows, max_age=max_age,
+                                         on_commit=self._mark_changed)
+        logger.info('Write buffer enabled for %s: max_rows=%d, max_age=%ss', self.table_name, max_rows, max_age)
+
+    @_instrumented
+    def flush_write_buffer(self) -> int:
+        """
+        Writes the rows queued by insert_one to the database in one transaction.
+
+        Returns:
+        - int: The number of rows written.
+        """
+        if self._write_buffer is None:
+            return 0
+        return self._write_buffer.flush()
+
+    def disable_write_buffer(self) -> None:
+        """
+        Flushes the queued rows, stops the background flushes and goes back to committing every insert_one.
+        """
+        if self._write_buffer is None:
+            return
+        self._write_buffer.close()
+        self._write_buffer = None
+        logger.info('Write buffer disabled for %s', self.table_name)
+
+    def write_buffer_stats(self) -> dict:
+        """
+        Returns the queue depth and flush statistics of the write buffer.
+
+        Returns:
+        - dict: queue_depth, flushes, flush_errors, rows_flushed, rows_failed, last_flush_seconds and max_flush_seconds,
+          or an empty dict when the buffer is not enabled.
+        """
+        if self._write_buffer is None:
+            return {}
+        return self._write_buffer.stats()
 
 
     def get_table_columns(self) -> list:
         """
         Retrieves a list of column names for the specified table.
 
+        The columns are read with PRAGMA table_info on the first call only, later calls use the cached list.
+
         Returns:
         - column_names (list): List of column names in the table.
         """
-        self.cursor.execute(f"PRAGMA table_info({self.table_name});")
-        columns = self.cursor.fetchall()
-        column_names = [col[1] for col in columns]
-        logger.info(f'The list of columns: {column_names}')
-        return column_names
+        return list(self.get_column_types())
+
+    def get_column_types(self) -> dict:
+        """
+        Retrieves the declared type of each column of the specified table.
+
+        The columns are cached once the table exists: while it does not, they are queried again on every call,
+        so a table created later (e.g. by create_schema) is noticed.
+
+        Returns:
+        - dict: The column names as keys and their declared types (e.g. 'INTEGER', 'FLOAT') as values.
+        """
+        if self._columns is None:
+            self.cursor.execute(f"PRAGMA table_info({self.table_name});")
+            columns = {col[1]: col[2] for col in self.cursor.fetchall()}
+            logger.info('The list of columns: %s', list(columns))
+            if not columns:
+                self._lower_columns = set()
+                return columns
+            self._columns = columns
+            self._lower_columns = {col.lower() for col in self._columns}
+        return self._columns
+
+    def refresh_table_columns(self) -> None:
+        """
+        Discards the cached columns and statements, so they are reloaded on the next use.
+        Call it after the table has been altered outside of this handler.
+        """
+        self._columns = None
+        self._statements.clear()
+
+    def _sql_column_names(self) -> set:
+        self.get_column_types()
+        return self._lower_columns
+
+    def _insert_query(self, columns: tuple) -> str:
+        key = ('insert', columns)
+        query = self._statements.get(key)
+        if query is None:
+            cols = ', '.join(columns)
+            params = ', '.join('?' for _ in columns)
+            logger.info('Insert structure: colnames: %s params: %s', cols, params)
+            query = f"""INSERT INTO {self.table_name} ({cols}) VALUES ({params});"""
+            self._statements[key] = query
+        return query
+
+    def _update_query(self, set_columns: tuple, where_columns: tuple) -> str:
+        key = ('update', set_columns, where_columns)
+        query = self._statements.get(key)
+        if query is None:
+            set_clause = ', '.join([f"{col} = ?" for col in set_columns])
+            where_clause = ' AND '.join([f"{col} = ?" for col in where_columns])
+            query = f"""
+                UPDATE {self.table_name}
+                SET {set_clause}
+                WHERE {where_clause};
+                    """
+            logger.info('Generated SQL query: %s', query)
+            self._statements[key] = query
+        return query
     
+    def _upsert_query(self, columns: tuple, key_columns: tuple) -> str:
+        key = ('upsert', columns, key_columns)
+        query = self._statements.get(key)
+        if query is None:
+            cols = ', '.join(columns)
+            params = ', '.join('?' for _ in columns)
+            set_columns = [col for col in columns if col not in key_columns]
+            action = ('DO UPDATE SET ' + ', '.join(f'{col} = excluded.{col}' for col in set_columns)
+                      if set_columns else 'DO NOTHING')
+            query = f"""
+                INSERT INTO {self.table_name} ({cols}) VALUES ({params})
+                ON CONFLICT ({', '.join(key_columns)}) {action};
+                    """
+            logger.info('Generated SQL query: %s', query)
+            self._statements[key] = query
+        return query
+
+    @_instrumented
     def truncate_table(self) -> None:
         """
         Truncates the specified table, removing all its data.
         """
         query = f"DELETE FROM {self.table_name};"
         self.cursor.execute(query)
-        self.cnxn.commit()
-        logging.info(f'The {self.table_name} is truncated')
+        self.commit()
+        logging.info('The %s is truncated', self.table_name)
         self.cursor.close()
 
+    @_instrumented
     def drop_table(self) -> None:
         """
         Deletes the specified table from the database.
@@ -153,80 +564,256 @@ class SqlHandler:
         query = f"DROP TABLE IF EXISTS {self.table_name};"
         logging.info(query)
         self.cursor.execute(query)
-        self.cnxn.commit()
-        logging.info(f"Table '{self.table_name}' deleted.")
+        self.commit()
+        self.refresh_table_columns()
+        logging.info("Table '%s' deleted.", self.table_name)
         logger.debug('Using drop table function')
 
-    def insert_many(self, df: pd.DataFrame) -> str:
+    @_instrumented
+    def insert_many(self, df: pd.DataFrame, commit: bool = True) -> str:
         """
         Inserts data from a pandas DataFrame into the specified table, mapping columns to their respective database columns.
 
         Parameters:
         - df (pd.DataFrame): The DataFrame containing data to be inserted.
+        - commit (bool): Whether to commit after the insert. Pass False to insert several DataFrames
+          in one transaction and call commit() (or roll back the connection) yourself.
 
         Returns:
         - str: A message indicating that the data has been loaded.
         """
-        df = df.replace(np.nan, None)  # For handling NULLS
-        df.rename(columns=lambda x: x.lower(), inplace=True)
-        columns = list(df.columns)
-        logger.info(f'BEFORE the column intersection: {columns}')
-        sql_column_names = [i.lower() for i in self.get_table_columns()]
-        columns = list(set(columns) & set(sql_column_names))
-        logger.info(f'AFTER the column intersection: {columns}')
-        ncolumns = list(len(columns) * '?')
-        data_to_insert = df.loc[:, columns]
-        values = [tuple(i) for i in data_to_insert.values]
-        logger.info(f'The shape of the table which is going to be imported {data_to_insert.shape}')
-        if len(columns) > 1:
-            cols, params = ', '.join(columns), ', '.join(ncolumns)
-        else:
-            cols, params = columns[0], ncolumns[0]
-        logger.info(f'Insert structure: colnames: {cols} params: {params}')
-        logger.info(values[0])
-        query = f"""INSERT INTO {self.table_name} ({cols}) VALUES ({params});"""
-        logger.info(f'QUERY: {query}')
+        if df.empty:
+            logger.warning('The DataFrame is empty, nothing to load')
+            return
+        # The messages are only formatted when their level is enabled, the first row and the query only at DEBUG
+        logger.info('BEFORE the column intersection: %s', [col.lower() for col in df.columns])
+        sql_column_names = self._sql_column_names()
+        # Mapping the DataFrame columns to the database columns without renaming (copying) the frame
+        df_columns = [col for col in df.columns if col.lower() in sql_column_names]
+        columns = [col.lower() for col in df_columns]
+        logger.info('AFTER the column intersection: %s', columns)
+        # For handling NULLS (NaN, NaT and pd.NA) and timestamps, as bulk_insert, update_many and upsert_many do
+        values = list(zip(*[_to_sql_values(df[col]) for col in df_columns]))
+        logger.info('The shape of the table which is going to be imported %s', (len(values), len(columns)))
+        logger.debug('First row: %s', values[0] if values else None)
+        query = self._insert_query(tuple(columns))
+        logger.debug('QUERY: %s', query)
         self.cursor.executemany(query, values)
+        SQL_ROWS.inc(len(values), table=self.table_name, method='insert_many')
         try:
             for i in self.cursor.messages:
                 logger.info(i)
         except:
             pass
-        self.cnxn.commit()
+        if commit:
+            self.commit()
         logger.warning('The data is loaded')
 
-    def from_sql_to_pandas(self, chunksize: int, id_value: str) -> pd.DataFrame:
+    @_instrumented
+    def bulk_insert(self, df: pd.DataFrame, batch_size: int = 50000, synchronous: str = 'NORMAL',
+                    rebuild_indexes: bool = False) -> dict:
         """
-        Retrieves data from the database and loads it into a pandas DataFrame in chunks of a specified size.
+        Inserts a large pandas DataFrame into the specified table in a single transaction, tuned for throughput.
+
+        - The database is switched to WAL journaling and the connection uses the given synchronous level
+          during the load (the previous level is restored afterwards).
+        - The rows are sent with executemany in batches of batch_size, built column by column from slices of
+          the DataFrame, so the frame is never copied as a whole.
+        - With rebuild_indexes, the secondary indexes of the table are dropped before the load and rebuilt
+          after it, which is faster than maintaining them row by row for very large loads.
 
         Parameters:
-        - chunksize (int): The chunksize for data extraction.
-        - id_value (str): The values by which the data should be sorted.
+        - df (pd.DataFrame): The DataFrame containing data to be inserted.
+        - batch_size (int): The number of rows sent to SQLite per executemany call.
+        - synchronous (str): The SQLite synchronous level used during the load ('OFF', 'NORMAL', 'FULL' or 'EXTRA').
+        - rebuild_indexes (bool): Whether to drop and rebuild the secondary indexes of the table around the load.
 
         Returns:
-        - pd.DataFrame: A DataFrame containing the retrieved data.
+        - dict: The number of rows loaded, the elapsed seconds and the rows per second.
+        """
+        synchronous = synchronous.upper()
+        if synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            raise ValueError(f'Invalid synchronous level: {synchronous}')
+
+        # Mapping the DataFrame columns to the database columns without renaming (copying) the frame
+        sql_column_names = self._sql_column_names()
+        df_columns = [col for col in df.columns if col.lower() in sql_column_names]
+        query = self._insert_query(tuple(col.lower() for col in df_columns))
+        logger.debug('QUERY: %s', query)
+
+        # The journal mode and the synchronous level cannot be changed inside a transaction
+        self.cnxn.commit()
+        previous_synchronous = self.cursor.execute('PRAGMA synchronous;').fetchone()[0]
+        self.cursor.execute('PRAGMA journal_mode=WAL;')
+        self.cursor.execute(f'PRAGMA synchronous={synchronous};')
+
+        start = time.perf_counter()
+        try:
+            self.cursor.execute('BEGIN;')
+            indexes = []
+            if rebuild_indexes:
+                # Indexes created for PRIMARY KEY / UNIQUE constraints have no SQL and cannot be dropped
+                indexes = self.cursor.execute(
+                    "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL;",
+                    (self.table_name,)).fetchall()
+                for name, _ in indexes:
+                    self.cursor.execute(f'DROP INDEX {name};')
+                logger.info('Dropped the indexes: %s', [name for name, _ in indexes])
+
+            for batch_start in range(0, len(df), batch_size):
+                batch = df.iloc[batch_start:batch_start + batch_size]
+                columns = [_to_sql_values(batch[col]) for col in df_columns]
+                self.cursor.executemany(query, zip(*columns))
+
+            for name, sql in indexes:
+                self.cursor.execute(sql)
+            if indexes:
+                logger.info('Rebuilt the indexes: %s', [name for name, _ in indexes])
+
+            self.commit()
+        except Exception:
+            self.cnxn.rollback()
+            raise
+        finally:
+            self.cursor.execute(f'PRAGMA synchronous={previous_synchronous};')
+
+        elapsed = time.perf_counter() - start
+        SQL_ROWS.inc(len(df), table=self.table_name, method='bulk_insert')
+        rows_per_second = len(df) / elapsed if elapsed > 0 else float('inf')
+        logger.warning('The data is loaded: %d rows in %.2fs (%.0f rows/s)', len(df), elapsed, rows_per_second)
+        return {'rows': len(df), 'seconds': elapsed, 'rows_per_second': rows_per_second}
+
+    @_instrumented
+    def iter_chunks(self, chunksize: int, id_value: str = 'rowid', columns: list = None,
+                    where: str = None, params: tuple = ()):
         """
-        offset = 0
-        dfs = []
+        Retrieves data from the database as a generator of pandas DataFrames using keyset pagination.
+
+        Every page continues from the last key seen (`WHERE (id_value, rowid) > (?, ?) ORDER BY id_value, rowid LIMIT n`)
+        instead of skipping all of the previous rows as OFFSET does. The rowid is used as a tie-breaker, which keeps
+        the pagination correct when id_value is not unique (e.g. customer_ID in FactPredictions).
+
+        The pages are only read straight from an index when id_value is the rowid or the first column of an index
+        (e.g. Customer_ID in DimCustomer). Otherwise SQLite sorts the remaining rows for every page, so a full read
+        costs O(N^2 / chunksize): prefer the default 'rowid' when the order of the rows does not matter.
+
+        Rows whose id_value is NULL are returned first (SQLite sorts NULL before any value), ordered by rowid.
+
+        Parameters:
+        - chunksize (int): The number of rows in each chunk.
+        - id_value (str): The column by which the data should be sorted and paginated.
+        - columns (list): The columns to select. All columns are selected if None.
+        - where (str): An optional SQL condition (without the WHERE keyword) used to filter the rows.
+        - params (tuple): The values for the '?' placeholders in the where condition.
+
+        Yields:
+        - pd.DataFrame: A chunk of at most chunksize rows.
+        """
+        cols = ', '.join(columns) if columns else '*'
+        conditions = [f'({where})'] if where else []
+        last_key = None
         while True:
+            page_conditions = list(conditions)
+            page_params = list(params)
+            if last_key is not None and last_key[0] is None:
+                # A NULL key compares as NULL, so the rest of the NULL keys are continued by rowid
+                page_conditions.append(f'({id_value} IS NOT NULL OR rowid > ?)')
+                page_params.append(last_key[1])
+            elif last_key is not None:
+                page_conditions.append(f'({id_value}, rowid) > (?, ?)')
+                page_params.extend(last_key)
+            where_clause = f"WHERE {' AND '.join(page_conditions)}" if page_conditions else ''
             query = f"""
-            SELECT * FROM {self.table_name}
-                ORDER BY {id_value} 
-                LIMIT {chunksize}
-                OFFSET {offset};
+            SELECT {cols}, {id_value} AS _keyset_id, rowid AS _keyset_rowid FROM {self.table_name}
+                {where_clause}
+                ORDER BY {id_value}, rowid
+                LIMIT {chunksize};
             """
-            data = pd.read_sql_query(query, self.cnxn)
-            logger.info(f'The shape of the chunk: {data.shape}')
-            dfs.append(data)
-            offset += chunksize
-            if len(dfs[-1]) < chunksize:
-                logger.warning('Loading the data from SQL is finished')
-                logger.debug('Connection is closed')
+            data = pd.read_sql_query(query, self.cnxn, params=page_params)
+            logger.info('The shape of the chunk: %s', data.shape)
+            SQL_ROWS.inc(len(data), table=self.table_name, method='iter_chunks')
+            if data.empty:
+                break
+            # sqlite3 cannot bind numpy scalars, so the key is converted to a native Python value
+            last_id = data['_keyset_id'].iat[-1]
+            if pd.isna(last_id):
+                last_id = None
+            last_key = (last_id.item() if hasattr(last_id, 'item') else last_id, int(data['_keyset_rowid'].iat[-1]))
+            yield data.drop(columns=['_keyset_id', '_keyset_rowid'])
+            if len(data) < chunksize:
                 break
+        logger.warning('Loading the data from SQL is finished')
+
+    @_instrumented
+    def from_sql_to_pandas(self, chunksize: int, id_value: str, columns: list = None,
+                           where: str = None, params: tuple = ()) -> pd.DataFrame:
+        """
+        Retrieves data from the database and loads it into a pandas DataFrame in chunks of a specified size.
+
+        Parameters:
+        - chunksize (int): The chunksize for data extraction.
+        - id_value (str): The values by which the data should be sorted.
+        - columns (list): The columns to select. All columns are selected if None.
+        - where (str): An optional SQL condition (without the WHERE keyword) used to filter the rows.
+        - params (tuple): The values for the '?' placeholders in the where condition.
+
+        Returns:
+        - pd.DataFrame: A DataFrame containing the retrieved data.
+        """
+        dfs = list(self.iter_chunks(chunksize, id_value, columns=columns, where=where, params=params))
+        if not dfs:
+            cols = ', '.join(columns) if columns else '*'
+            return pd.read_sql_query(f"SELECT {cols} FROM {self.table_name} LIMIT 0;", self.cnxn)
         df = pd.concat(dfs)
         return df
 
+    @_instrumented
+    def count_rows(self, where: str = None, params: tuple = ()) -> int:
+        """
+        Counts the rows of the specified table, optionally filtered by a condition.
+
+        Parameters:
+        - where (str): An optional SQL condition (without the WHERE keyword) used to filter the rows.
+        - params (tuple): The values for the '?' placeholders in the where condition.
+
+        Returns:
+        - int: The number of matching rows.
+        """
+        where_clause = f'WHERE {where}' if where else ''
+        self.cursor.execute(f"SELECT COUNT(*) FROM {self.table_name} {where_clause};", params)
+        return self.cursor.fetchone()[0]
+
+    @_instrumented
+    def select_top(self, order_by: str, limit: int, columns: list = None,
+                   where: str = None, params: tuple = ()) -> pd.DataFrame:
+        """
+        Retrieves the first rows of the specified table according to an ordering, letting SQLite do the filtering,
+        sorting and limiting (and use an index for it when one exists).
+
+        Parameters:
+        - order_by (str): The ORDER BY expression (e.g. 'Churn_Rate DESC, CLV DESC').
+        - limit (int): The maximum number of rows to return.
+        - columns (list): The columns to select. All columns are selected if None.
+        - where (str): An optional SQL condition (without the WHERE keyword) used to filter the rows.
+        - params (tuple): The values for the '?' placeholders in the where condition.
+
+        Returns:
+        - pd.DataFrame: A DataFrame containing at most limit rows.
+        """
+        cols = ', '.join(columns) if columns else '*'
+        where_clause = f'WHERE {where}' if where else ''
+        query = f"""
+            SELECT {cols} FROM {self.table_name}
+                {where_clause}
+                ORDER BY {order_by}
+                LIMIT ?;
+            """
+        data = pd.read_sql_query(query, self.cnxn, params=list(params) + [int(limit)])
+        SQL_ROWS.inc(len(data), table=self.table_name, method='select_top')
+        return data
+
    
+    @_instrumented
     def update_table(self, set_dict: dict, cond_dict: dict) -> str:
         """
         Update rows in a database table based on the set and where conditions provided in dictionaries.
@@ -240,8 +827,7 @@ class SqlHandler:
         """
         
         #getting the db column names
-        columns = self.get_table_columns()
-        sql_column_names = [col.lower() for col in columns]
+        sql_column_names = self._sql_column_names()
 
         # Convert keys to lowercase
         set_dict = {key.lower(): value for key, value in set_dict.items()}
@@ -252,30 +838,101 @@ class SqlHandler:
         cond_dict = {key: value for key, value in cond_dict.items() if key in sql_column_names}    
         
         try:
-            # Generate the SET clause
-            set_clause = ', '.join([f"{col} = ?" for col in set_dict.keys()])
+            # Build the SQL query from the SET and WHERE columns
+            query = self._update_query(tuple(set_dict), tuple(cond_dict))
             set_values = list(set_dict.values())
-            logger.info(f'Set Clause Structure: {set_clause}')
-
-            # Generate the WHERE clause
-            where_clause = ' AND '.join([f"{col} = ?" for col in cond_dict.keys()])
             where_values = list(cond_dict.values())  # Add values for the WHERE clause
-            logger.info(f'Where Clause Structure: {where_clause}')
-
-            # Build the SQL query
-            query = f"""
-                UPDATE {self.table_name}
-                SET {set_clause}
-                WHERE {where_clause};
-                    """
-            logger.info(f'Generated SQL query: {query}')  # Log the generated query
             self.cursor.execute(query, set_values + where_values)  # Combine SET and WHERE values
 
-            self.cnxn.commit()
-            logger.warning(f'The table {self.table_name} is updated.')
+            self.commit()
+            logger.warning('The table %s is updated.', self.table_name)
         except Exception as e:
-            logger.warning(f"Error updating rows: {e}")
+            # The error is not raised, so it is counted here
+            SQL_ERRORS.inc(table=self.table_name, method='update_table')
+            logger.warning("Error updating rows: %s", e)
+
+    @_instrumented
+    def update_many(self, df: pd.DataFrame, key_columns: list, batch_size: int = 50000) -> int:
+        """
+        Updates many rows in a single transaction from a DataFrame of keys and new values.
+
+        Every row of the DataFrame becomes one `UPDATE ... SET <other columns> = ? WHERE <key columns> = ?`,
+        sent to SQLite with executemany in batches of batch_size. Unlike update_table, errors are not
+        swallowed: the transaction is rolled back and the exception is raised.
+
+        Parameters:
+        - df (pd.DataFrame): The keys and the new values, one row per row to update.
+        - key_columns (list): The columns of df identifying the rows to update (e.g. ['customer_ID', 'pred_period']).
+          The other columns of df that exist in the table are the ones updated.
+        - batch_size (int): The number of rows sent to SQLite per executemany call.
 
-            
+        Returns:
+        - int: The number of rows updated.
+        """
+        sql_column_names = self._sql_column_names()
+        missing = [col for col in key_columns if col.lower() not in sql_column_names]
+        if missing:
+            raise ValueError(f'The key columns {missing} are not in the table {self.table_name}')
+        key_lookup = {col.lower() for col in key_columns}
+        set_columns = [col for col in df.columns if col.lower() in sql_column_names and col.lower() not in key_lookup]
+        if not set_columns:
+            raise ValueError(f'No column of the DataFrame can be updated in the table {self.table_name}')
+
+        query = self._update_query(tuple(col.lower() for col in set_columns), tuple(col.lower() for col in key_columns))
+        changes_before = self.cnxn.total_changes
+        try:
+            for batch_start in range(0, len(df), batch_size):
+                batch = df.iloc[batch_start:batch_start + batch_size]
+                columns = [_to_sql_values(batch[col]) for col in set_columns + list(key_columns)]
+                self.cursor.executemany(query, zip(*columns))
+            self.commit()
+        except Exception:
+            self.cnxn.rollback()
+            raise
+
+        updated = self.cnxn.total_changes - changes_before
+        SQL_ROWS.inc(updated, table=self.table_name, method='update_many')
+        logger.warning('The table %s is updated: %d rows.', self.table_name, updated)
+        return updated
+
+    @_instrumented
+    def upsert_many(self, df: pd.DataFrame, key_columns: list, batch_size: int = 50000, commit: bool = True) -> int:
+        """
+        Inserts the rows of a DataFrame, or updates the existing rows with the same keys, in a single transaction.
 
+        Every row of the DataFrame becomes one `INSERT ... ON CONFLICT (<key columns>) DO UPDATE SET <other columns>`,
+        sent to SQLite with executemany in batches of batch_size. The key columns must be the primary key of the
+        table or a unique index. Errors are raised after the transaction is rolled back.
 
+        Parameters:
+        - df (pd.DataFrame): The rows to insert or update.
+        - key_columns (list): The columns of df identifying the rows (e.g. ['customer_ID', 'pred_period']).
+        - batch_size (int): The number of rows sent to SQLite per executemany call.
+        - commit (bool): Whether to commit after the upsert. Pass False to write to several tables
+          in one transaction and call commit() (or roll back the connection) yourself.
+
+        Returns:
+        - int: The number of rows inserted or updated.
+        """
+        sql_column_names = self._sql_column_names()
+        missing = [col for col in key_columns if col.lower() not in sql_column_names]
+        if missing:
+            raise ValueError(f'The key columns {missing} are not in the table {self.table_name}')
+        columns = [col for col in df.columns if col.lower() in sql_column_names]
+
+        query = self._upsert_query(tuple(col.lower() for col in columns), tuple(col.lower() for col in key_columns))
+        changes_before = self.cnxn.total_changes
+        try:
+            for batch_start in range(0, len(df), batch_size):
+                batch = df.iloc[batch_start:batch_start + batch_size]
+                self.cursor.executemany(query, zip(*[_to_sql_values(batch[col]) for col in columns]))
+            if commit:
+                self.commit()
+        except Exception:
+            self.cnxn.rollback()
+            raise
+
+        upserted = self.cnxn.total_changes - changes_before
+        SQL_ROWS.inc(upserted, table=self.table_name, method='upsert_many')
+        logger.warning('The table %s is upserted: %d rows.', self.table_name, upserted)
+        return upserted
@@ -1 +1 @@
-from .logger import CustomFormatter
\ No newline at end of file
+from .logger import CustomFormatter, get_log_level
\ No newline at end of file
@@ -1,4 +1,29 @@
 import logging
+import os
+
+
+def get_log_level(name: str = None) -> int:
+    """
+    Returns the log level of a module, configurable through the environment:
+    SA_LOG_LEVEL_<MODULE> (e.g. SA_LOG_LEVEL_SQL_INTERACTIONS=WARNING) for one module, SA_LOG_LEVEL for all of them.
+
+    Parameters:
+    - name (str): The name of the logger (e.g. 'sql_interactions.py').
+
+    Returns:
+    - int: The log level, DEBUG when none is configured.
+    """
+    level = None
+    if name:
+        module = os.path.splitext(os.path.basename(name))[0].upper()
+        level = os.environ.get(f'SA_LOG_LEVEL_{module}')
+    level = (level or os.environ.get('SA_LOG_LEVEL') or 'DEBUG').strip().upper()
+    if level.isdigit():
+        return int(level)
+    # getLevelName returns a string for unknown level names
+    value = logging.getLevelName(level)
+    return value if isinstance(value, int) else logging.DEBUG
+
 
 class CustomFormatter(logging.Formatter):
     
@@ -19,6 +44,11 @@ class CustomFormatter(logging.Formatter):
         logging.ERROR: red + format + reset,
         logging.CRITICAL: bold_red + format + reset
     }
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # One formatter per level, built once instead of for every record
+        self._formatters = {level: logging.Formatter(log_fmt) for level, log_fmt in self.FORMATS.items()}
+
     def format(self, record):
         """
 
@@ -31,8 +61,9 @@ class CustomFormatter(logging.Formatter):
         -------
         returns formated(colored) output
         """
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
+        formatter = self._formatters.get(record.levelno)
+        if formatter is None:
+            formatter = logging.Formatter(self.FORMATS.get(record.levelno))
         return formatter.format(record)
 
 
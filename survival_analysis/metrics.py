@@ -0,0 +1,306 @@
+"""
+Module: metrics.py
+
+This module keeps in-process counters and latency histograms of the package (SqlHandler methods, API routes and
+AFTModelSelector stages) and renders them in the Prometheus text exposition format, e.g. for the API's /metrics
+endpoint. It only uses the standard library, so it adds nothing to the import time of the package.
+
+Recording a value takes a lock and a dictionary lookup; setting the environment variable SA_METRICS=0 turns the
+instrumentation into no-ops (the decorators then return the functions unchanged).
+
+Methods:
+
+- Registry.counter(self, name: str, documentation: str, labelnames: tuple) -> Counter:
+    Returns the counter of a name, creating it on first use.
+
+- Registry.histogram(self, name: str, documentation: str, labelnames: tuple, buckets: tuple) -> Histogram:
+    Returns the histogram of a name, creating it on first use.
+
+- Registry.render(self) -> str:
+    Renders every metric in the Prometheus text format.
+
+- Counter.inc(self, amount: float, **labels) -> None:
+    Increments the counter of a set of labels.
+
+- Histogram.observe(self, value: float, **labels) -> None:
+    Records one observation for a set of labels.
+
+- Histogram.time(self, **labels):
+    A context manager recording the duration of its block.
+
+- enabled() -> bool:
+    Whether the instrumentation is enabled.
+
+- timed(histogram: Histogram, errors: Counter, labels: callable):
+    A decorator recording the duration and the exceptions of a function or a generator.
+
+"""
+
+import functools
+import inspect
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds, from sub-millisecond queries to model fits of several minutes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                   300.0)
+
+
+def enabled() -> bool:
+    """
+    Whether the instrumentation is enabled (it is unless the environment variable SA_METRICS is 0, false or off).
+
+    Returns:
+    - bool: True if the metrics are recorded.
+    """
+    return os.environ.get('SA_METRICS', '1').strip().lower() not in ('0', 'false', 'off', 'no')
+
+
+# Read once, recording a value is then a no-op when the metrics are disabled
+ENABLED = enabled()
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A monotonically increasing counter, one value per combination of label values.
+
+    Parameters:
+    - name (str): The metric name.
+    - documentation (str): The help text of the metric.
+    - labelnames (tuple): The names of the labels.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        if not ENABLED:
+            return
+        self._inc(tuple(labels[name] for name in self.labelnames), amount)
+
+    def _inc(self, key: tuple, amount: float = 1) -> None:
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def samples(self) -> list:
+        with self._lock:
+            values = dict(self._values)
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+                for key, value in sorted(values.items())]
+
+
+class Histogram:
+    """
+    A histogram of observations (e.g. durations in seconds), one per combination of label values.
+
+    Parameters:
+    - name (str): The metric name.
+    - documentation (str): The help text of the metric.
+    - labelnames (tuple): The names of the labels.
+    - buckets (tuple): The increasing upper bounds of the buckets.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Label values -> [count per bucket (the last one is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        if not ENABLED:
+            return
+        self._observe(tuple(labels[name] for name in self.labelnames), value)
+
+    def _observe(self, key: tuple, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        entry = self._values.get(tuple(labels[name] for name in self.labelnames))
+        return sum(entry[0]) if entry else 0
+
+    def samples(self) -> list:
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            # The bucket counts of the exposition format are cumulative
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(float(bound))}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Registry:
+    """
+    The collection of the metrics of the process.
+    """
+
+    def __init__(self) -> None:
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args)
+            elif not isinstance(metric, cls):
+                raise ValueError(f'The metric {name} is already registered as a {metric.kind}')
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        """
+        Returns the counter of a name, creating it on first use.
+
+        Parameters:
+        - name (str): The metric name (e.g. 'sa_sql_errors_total').
+        - documentation (str): The help text of the metric.
+        - labelnames (tuple): The names of the labels.
+
+        Returns:
+        - Counter: The counter.
+        """
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        """
+        Returns the histogram of a name, creating it on first use.
+
+        Parameters:
+        - name (str): The metric name (e.g. 'sa_sql_operation_seconds').
+        - documentation (str): The help text of the metric.
+        - labelnames (tuple): The names of the labels.
+        - buckets (tuple): The increasing upper bounds of the buckets.
+
+        Returns:
+        - Histogram: The histogram.
+        """
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets)
+
+    def render(self) -> str:
+        """
+        Renders every metric in the Prometheus text exposition format (version 0.0.4).
+
+        Returns:
+        - str: The metrics, one sample per line.
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {_escape(metric.documentation)}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+# The registry of the process, rendered by the API's /metrics endpoint
+REGISTRY = Registry()
+
+
+def timed(histogram: Histogram, errors: Counter = None, labels=None):
+    """
+    A decorator recording the duration and the exceptions of a function. The duration of a generator function
+    is measured from the first item requested until it is exhausted or closed.
+    When the metrics are disabled, the function is returned unchanged.
+
+    Parameters:
+    - histogram (Histogram): The histogram of the durations.
+    - errors (Counter): The counter of the calls that raised an exception, optional.
+    - labels (callable): Called with the arguments of the function, returns the values of the labels of the call
+      as a tuple, in the order of the labelnames of the histogram (and of the counter).
+
+    Returns:
+    - callable: The decorator.
+    """
+    def decorator(function):
+        if not ENABLED:
+            return function
+
+        # The label values are passed positionally, so a call costs a few microseconds at most
+        def get_labels(args, kwargs) -> tuple:
+            return labels(*args, **kwargs) if labels is not None else ()
+
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def generator_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    yield from function(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors._inc(get_labels(args, kwargs))
+                    raise
+                finally:
+                    histogram._observe(get_labels(args, kwargs), time.perf_counter() - start)
+            return generator_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors._inc(get_labels(args, kwargs))
+                raise
+            finally:
+                histogram._observe(get_labels(args, kwargs), time.perf_counter() - start)
+        return wrapper
+    return decorator
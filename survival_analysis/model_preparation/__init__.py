@@ -1,2 +1,15 @@
 from ..logger import CustomFormatter
-from .model_AFT import AFTModelSelector
\ No newline at end of file
+from .model_cache import ModelCache
+
+def __getattr__(name):
+    # lifelines and autograd are imported only when the model is needed
+    if name == 'AFTModelSelector':
+        from .model_AFT import AFTModelSelector
+        return AFTModelSelector
+    if name == 'SurvivalScorer':
+        from .scoring import SurvivalScorer
+        return SurvivalScorer
+    if name == 'ChunkedScorer':
+        from .chunked_scoring import ChunkedScorer
+        return ChunkedScorer
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,282 @@
+"""
+Module: chunked_scoring.py
+
+This module defines a class called 'ChunkedScorer', which scores a customer base of any size chunk by chunk with a
+fitted AFT model: every chunk of customers goes through the encoding, the survival predictions and the CLV
+computation, and its predictions are written to FactPredictions (or a file) before the next chunk is read.
+
+Only the coefficients of the model (see SurvivalScorer) and the fitted encoder stay in memory, so the peak memory
+is bounded by the chunk size whatever the number of customers: about chunksize x (number of covariates + 6 x
+n_time_periods) values.
+
+The predictions are the ones of AFTModelSelector.fit_and_predict followed by calculate_clv, in the same long format
+(customer_id, pred_period, churn_rate, CLV), ordered by period within each chunk.
+
+Methods:
+
+- ChunkedScorer.from_selector(selector: AFTModelSelector, n_time_periods: int, encoder: DataFrameEncoder, ...) -> ChunkedScorer:
+    Creates the scorer of the model selected by an AFTModelSelector.
+
+- ChunkedScorer.score(self, chunk: pd.DataFrame) -> pd.DataFrame:
+    Computes the churn and CLV predictions of one chunk of customers.
+
+- ChunkedScorer.run(self, chunks, sink) -> dict:
+    Scores every chunk and writes its predictions to a sink.
+
+- ChunkedScorer.fingerprint(self) -> int:
+    Returns a hash of the model, the encoder and the scoring parameters.
+
+- ChunkedScorer.rescore_changed(self, customers: SqlHandler, chunksize: int, delete_missing: bool) -> dict:
+    Scores only the new and modified customers of DimCustomer and upserts their rows of FactPredictions.
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+import numpy as np
+import pandas as pd
+from ..logger import CustomFormatter, get_log_level
+from ..database_preparation.sql_interactions import SqlHandler
+from ..utils import DataFrameEncoder
+from .model_AFT import calculate_clv_matrix
+from .scoring import SurvivalScorer
+
+# The table of the content hashes of the scored customers (see schema.CustomerHash)
+HASH_TABLE = 'DimCustomerHash'
+
+# Initialize and configure the logger
+logger = logging.getLogger(os.path.basename(__file__))
+logger.setLevel(get_log_level(logger.name))
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(CustomFormatter())
+logger.addHandler(ch)
+
+
+def _row_hash(fingerprint: int):
+    # The SQLite function hashing the values of a row together with the fingerprint of the scoring, as a signed
+    # 64-bit integer; repr keeps the types apart (5, 5.0, '5' and NULL hash differently) and is stable across runs
+    def row_hash(*values) -> int:
+        digest = hashlib.blake2b(repr(values).encode(), digest_size=8, key=fingerprint.to_bytes(8, 'little'))
+        return int.from_bytes(digest.digest(), 'little', signed=True)
+    return row_hash
+
+
+class _CSVWriter:
+    # Writes the prediction chunks to one CSV file, the header with the first chunk
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.header = True
+
+    def __call__(self, predictions: pd.DataFrame) -> None:
+        predictions.to_csv(self.path, mode='w' if self.header else 'a', header=self.header, index=False)
+        self.header = False
+
+
+class ChunkedScorer:
+    """
+    Scores chunks of customers with the coefficients of a fitted AFT model and writes their predictions to a sink.
+
+    Parameters:
+    - scorer (SurvivalScorer): The survival function of the fitted model.
+    - primary_col (str): The column name representing the primary key of the customers.
+    - n_time_periods (int): The number of time periods for which predictions are generated.
+    - encoder (DataFrameEncoder): The encoder fitted on the training data, applied to every raw chunk
+      (e.g. the chunks of DimCustomer). None if the chunks are already encoded.
+    - MM (float): A constant representing the monetary value.
+    - r (float): The periodic interest rate for discounting.
+    - dtype (np.dtype): The dtype of the design matrix, np.float64 (the default) or np.float32.
+    """
+
+    def __init__(self, scorer: SurvivalScorer, primary_col: str, n_time_periods: int,
+                 encoder: DataFrameEncoder = None, MM=1300, r=0.1, dtype=np.float64) -> None:
+        self.scorer = scorer
+        self.primary = primary_col
+        self.time_periods = np.arange(1, n_time_periods + 1)
+        self.encoder = encoder
+        self.MM = MM
+        self.r = r
+        self.dtype = dtype
+
+    @classmethod
+    def from_selector(cls, selector, n_time_periods: int, encoder: DataFrameEncoder = None, MM=1300, r=0.1,
+                      dtype=np.float64) -> 'ChunkedScorer':
+        """
+        Creates the scorer of the model selected by an AFTModelSelector (see select_best_model).
+        The selector, and its training data, can be released afterwards.
+
+        Parameters:
+        - selector (AFTModelSelector): The selector holding the fitted model.
+        - n_time_periods (int): The number of time periods for which predictions are generated.
+        - encoder (DataFrameEncoder): The encoder fitted on the training data, None if the chunks are already encoded.
+        - MM (float): A constant representing the monetary value.
+        - r (float): The periodic interest rate for discounting.
+        - dtype (np.dtype): The dtype of the design matrix.
+
+        Returns:
+        - ChunkedScorer: The scorer.
+        """
+        if selector.aft_model is None:
+            raise ValueError("Please run select_best_model() first.")
+        return cls(SurvivalScorer.from_model(selector.aft_model), selector.primary, n_time_periods,
+                   encoder=encoder, MM=MM, r=r, dtype=dtype)
+
+    def score(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        """
+        Computes the churn and CLV predictions of one chunk of customers. The chunk is not modified.
+
+        Parameters:
+        - chunk (pd.DataFrame): The customers, raw if an encoder is set, encoded otherwise.
+
+        Returns:
+        - pd.DataFrame: The predictions in the long format (customer_id, pred_period, churn_rate, CLV).
+        """
+        data = self.encoder.transform(chunk) if self.encoder is not None else chunk
+        X = self.scorer.design_matrix(data, dtype=self.dtype)
+        survival = self.scorer.survival_function(X, self.time_periods)
+        del X
+
+        # The churn rates are rounded as in fit_and_predict, and the CLV is computed from the rounded rates
+        # as calculate_clv does, so that the predictions do not depend on the chunking
+        churn = np.round(1 - survival.astype(float, copy=False), 5)
+        clv = calculate_clv_matrix(1 - churn, MM=self.MM, r=self.r)
+
+        # customers x periods -> all the customers for period 1, then for period 2, ...
+        customer_ids = data[self.primary].to_numpy()
+        n_time_periods = len(self.time_periods)
+        return pd.DataFrame({
+            'customer_id': np.tile(customer_ids, n_time_periods),
+            'pred_period': np.repeat(self.time_periods, len(customer_ids)),
+            'churn_rate': churn.T.ravel(),
+            'CLV': clv.T.ravel(),
+        })
+
+    def run(self, chunks, sink) -> dict:
+        """
+        Scores every chunk and writes its predictions to a sink before reading the next chunk.
+
+        Parameters:
+        - chunks (iterable): The chunks of customers, e.g. SqlHandler('sa_db', 'DimCustomer').iter_chunks(100000, 'Customer_ID').
+        - sink: Where the predictions are written:
+          - a SqlHandler, e.g. SqlHandler('sa_db', 'FactPredictions'): every chunk is loaded with bulk_insert.
+          - a file path (str or os.PathLike): the predictions are written as one CSV file.
+          - a callable: it is called with the predictions of every chunk.
+
+        Returns:
+        - dict: The number of chunks, customers and prediction rows, and the elapsed seconds.
+        """
+        if isinstance(sink, SqlHandler):
+            write = sink.bulk_insert
+        elif isinstance(sink, (str, os.PathLike)):
+            write = _CSVWriter(sink)
+        elif callable(sink):
+            write = sink
+        else:
+            raise TypeError(f'Unsupported sink: {type(sink).__name__}')
+
+        start = time.perf_counter()
+        n_chunks = n_customers = n_rows = 0
+        for chunk in chunks:
+            if chunk.empty:
+                continue
+            predictions = self.score(chunk)
+            write(predictions)
+            n_chunks += 1
+            n_customers += len(chunk)
+            n_rows += len(predictions)
+            logger.info('Scored chunk %d: %d customers (%d in total)', n_chunks, len(chunk), n_customers)
+            del chunk, predictions
+
+        if isinstance(write, _CSVWriter) and write.header:
+            # No chunk: a file with the header only
+            write(pd.DataFrame(columns=['customer_id', 'pred_period', 'churn_rate', 'CLV']))
+
+        elapsed = time.perf_counter() - start
+        logger.warning('Scored %d customers in %d chunks (%d predictions) in %.2fs', n_customers, n_chunks, n_rows, elapsed)
+        return {'chunks': n_chunks, 'customers': n_customers, 'rows': n_rows, 'seconds': elapsed}
+
+    def fingerprint(self) -> int:
+        """
+        Returns a hash of everything the predictions depend on besides the customer's row: the coefficients of the
+        model, the encoder, the time periods, MM, r and the dtype.
+
+        Returns:
+        - int: A 64-bit unsigned hash.
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps([self.scorer.family, self.scorer.columns, self.time_periods.tolist(),
+                                  self.MM, self.r, np.dtype(self.dtype).name]).encode())
+        digest.update(self.scorer.coefficients.tobytes())
+        if self.encoder is not None:
+            digest.update(json.dumps(self.encoder.to_dict(), sort_keys=True, default=str).encode())
+        return int.from_bytes(digest.digest()[:8], 'little')
+
+    def rescore_changed(self, customers: SqlHandler, chunksize: int = 100000, delete_missing: bool = True) -> dict:
+        """
+        Scores only the customers of DimCustomer that are new or were modified since they were last scored,
+        and upserts their rows of FactPredictions.
+
+        Every customer is hashed from its row as stored in SQLite combined with fingerprint(). The hash of a scored
+        customer is kept in the DimCustomerHash table, so a customer is scored again when its row changes (whoever
+        wrote it, and a reload of unchanged rows changes nothing), and every customer is when the model or the
+        scoring parameters change. The hashes are computed and compared inside SQLite while DimCustomer is scanned,
+        so only the rows of the changed customers are read into pandas. The predictions and the hashes of every
+        chunk are written in one transaction.
+
+        Parameters:
+        - customers (SqlHandler): The handler of the DimCustomer table, whose connection is used for every table.
+        - chunksize (int): The number of changed customers scored at once.
+        - delete_missing (bool): Whether to delete the predictions and the hashes of the customers scored by a previous
+          run and deleted from DimCustomer since.
+
+        Returns:
+        - dict: The number of customers checked, scored and deleted, and the elapsed seconds.
+        """
+        start = time.perf_counter()
+        predictions = SqlHandler(customers.dbname, 'FactPredictions', cnxn=customers.cnxn)
+        hashes = SqlHandler(customers.dbname, HASH_TABLE, cnxn=customers.cnxn)
+        if not hashes.get_table_columns():
+            # Databases created before the table was added
+            from ..database_preparation.schema import create_schema
+            create_schema(f'sqlite:///{customers.dbname}.db').dispose()
+
+        customers.cnxn.create_function('sa_row_hash', -1, _row_hash(self.fingerprint()), deterministic=True)
+        table = customers.table_name
+        row_hash = f"sa_row_hash({', '.join(f'{table}.{col}' for col in customers.get_table_columns())})"
+        changed = f'(SELECT Content_Hash FROM {HASH_TABLE} WHERE Customer_ID = {table}.{self.primary}) IS NOT {row_hash}'
+
+        n_scored = 0
+        for chunk in customers.iter_chunks(chunksize, self.primary, columns=['*', f'{row_hash} AS _content_hash'],
+                                           where=changed):
+            new_hashes = pd.DataFrame({'Customer_ID': chunk[self.primary], 'Content_Hash': chunk['_content_hash']})
+            predictions.upsert_many(self.score(chunk), ['customer_id', 'pred_period'], commit=False)
+            hashes.upsert_many(new_hashes, ['Customer_ID'], commit=False)
+            predictions.commit()
+            hashes.commit()
+            n_scored += len(chunk)
+            logger.info('Scored %d new or modified customers (%d in total)', len(chunk), n_scored)
+
+        n_deleted = 0
+        if delete_missing:
+            deleted = [row[0] for row in customers.cursor.execute(
+                f'SELECT Customer_ID FROM {HASH_TABLE} WHERE Customer_ID NOT IN (SELECT {self.primary} FROM {table});')]
+            if deleted:
+                # One primary key lookup per period and customer, FactPredictions is not scanned
+                customers.cursor.executemany(
+                    'DELETE FROM FactPredictions WHERE pred_period = ? AND customer_ID = ?;',
+                    [(int(period), customer_id) for period in self.time_periods for customer_id in deleted])
+                customers.cursor.executemany(f'DELETE FROM {HASH_TABLE} WHERE Customer_ID = ?;',
+                                             [(customer_id,) for customer_id in deleted])
+                predictions.commit()
+                hashes.commit()
+                n_deleted = len(deleted)
+
+        n_checked = customers.count_rows()
+        elapsed = time.perf_counter() - start
+        logger.warning('Re-scored %d new or modified customers of %d and deleted %d in %.2fs',
+                       n_scored, n_checked, n_deleted, elapsed)
+        return {'checked': n_checked, 'scored': n_scored, 'deleted': n_deleted, 'seconds': elapsed}
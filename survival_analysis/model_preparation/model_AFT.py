@@ -1,27 +1,102 @@
 import pandas as pd
 import os
+import time
 import logging
-from ..logger import CustomFormatter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from numpy.linalg import LinAlgError
+from ..logger import CustomFormatter, get_log_level
+from .model_cache import ModelCache
+from .scoring import FAMILIES, SurvivalScorer
+from ..metrics import REGISTRY, timed
+from ..profiling import profiled
 from lifelines import WeibullAFTFitter, LogNormalAFTFitter, LogLogisticAFTFitter
+from lifelines.exceptions import ConvergenceError
 from lifelines.fitters import ParametricRegressionFitter
 from autograd import numpy as np
 
 # Initialize and configure the logger
 logger = logging.getLogger(os.path.basename(__file__))
-logger.setLevel(logging.DEBUG)
+logger.setLevel(get_log_level(logger.name))
 ch = logging.StreamHandler()
 ch.setLevel(logging.DEBUG)
 ch.setFormatter(CustomFormatter())
 logger.addHandler(ch)
 
+# Metrics of the model selection and scoring stages, rendered by the API's /metrics endpoint
+MODEL_STAGE_SECONDS = REGISTRY.histogram('sa_model_stage_seconds', 'Duration of the AFTModelSelector stages.', ('stage',))
+MODEL_STAGE_ERRORS = REGISTRY.counter('sa_model_stage_errors_total', 'AFTModelSelector stages that failed.', ('stage',))
+MODEL_FIT_SECONDS = REGISTRY.histogram('sa_model_fit_seconds', 'Duration of the candidate model fits.', ('model', 'converged'))
+
+def _stage(name: str):
+    # Records the duration and the failures of an AFTModelSelector stage
+    return timed(MODEL_STAGE_SECONDS, MODEL_STAGE_ERRORS, lambda *args, **kwargs: (name,))
+
+
+def _exponential_newton_raphson(X, T, E, W, max_steps: int = 100, precision: float = 1e-10):
+    """
+    Maximizes the log-likelihood of a right censored Exponential AFT model by Newton-Raphson.
+
+    With eta = X beta, the log-likelihood is sum(W * (-E * eta - T * exp(-eta))), so the gradient and the Hessian
+    of its negative are X'(W * (E - mu)) and X' diag(mu) X, where mu = W * T * exp(-eta).
+    The log-likelihood is concave, and each step is halved until it increases.
+
+    Parameters:
+    - X (np.ndarray): The customers x covariates design matrix.
+    - T (np.ndarray): The durations.
+    - E (np.ndarray): The event indicators.
+    - W (np.ndarray): The weights.
+    - max_steps (int): The maximum number of Newton steps.
+    - precision (float): The largest change of a coefficient below which the fit has converged.
+
+    Returns:
+    - tuple: The coefficients, the log-likelihood and the Hessian of the negative log-likelihood,
+      or None if the fit did not converge.
+    """
+    WE = W * E
+
+    def negative_log_likelihood(beta):
+        eta = X @ beta
+        return np.sum(WE * eta + W * T * np.exp(-eta))
+
+    beta = np.zeros(X.shape[1])
+    value = negative_log_likelihood(beta)
+    for _ in range(max_steps):
+        mu = W * T * np.exp(-(X @ beta))
+        try:
+            step = np.linalg.solve((X * mu[:, None]).T @ X, X.T @ (WE - mu))
+        except LinAlgError:
+            return None
+
+        scale = 1.0
+        candidate_value = negative_log_likelihood(beta - step)
+        while not candidate_value <= value and scale > 1e-10:
+            scale /= 2
+            candidate_value = negative_log_likelihood(beta - scale * step)
+        if not np.isfinite(candidate_value):
+            return None
+        beta, value = beta - scale * step, min(candidate_value, value)
+
+        if np.max(np.abs(scale * step), initial=0.0) < precision:
+            mu = W * T * np.exp(-(X @ beta))
+            return beta, -value, (X * mu[:, None]).T @ X
+    return None
+
 
 class ExponentialAFTFitter(ParametricRegressionFitter):
     '''
     This is a class for implementing an Exponential AFT Fitter Model.
+
+    The right censored fits without penalizer, entry times, initial point or fit options are solved by
+    Newton-Raphson with the closed-form gradient and Hessian of the log-likelihood, instead of by BFGS with
+    autograd derivatives. The other fits, and the ones where Newton-Raphson fails, use the generic lifelines fit.
     '''
     # this class property is necessary, and should always be a non-empty list of strings.
     _fitted_parameter_names = ['lambda_']
 
+    # Set to False to always use the generic lifelines fit
+    analytic_fit = True
+
     def _cumulative_hazard(self, params, t, Xs):
         # params is a dictionary that maps unknown parameters to a numpy vector.
         # Xs is a dictionary that maps unknown parameters to a numpy 2d array
@@ -30,6 +105,65 @@ class ExponentialAFTFitter(ParametricRegressionFitter):
         lambda_ = np.exp(np.dot(X, beta))
         return t / lambda_
 
+    def _fit_model(self, likelihood, Ts, Xs, E, weights, entries, fit_options, show_progress=False,
+                   user_supplied_initial_point=None):
+        # Called by lifelines' fit with the normalized design matrix, returns the coefficients, the log-likelihood
+        # and the Hessian of the negative log-likelihood as lifelines' _fit_model does
+        result = None
+        if (self.analytic_fit and getattr(likelihood, '__name__', None) == '_log_likelihood_right_censoring'
+                and not fit_options and user_supplied_initial_point is None
+                and not np.any(self.penalizer) and not np.any(entries > 0)):
+            result = _exponential_newton_raphson(Xs.to_numpy(dtype=float), np.asarray(Ts[0], dtype=float),
+                                                 np.asarray(E, dtype=float), np.asarray(weights, dtype=float))
+            if result is None:
+                logger.warning("The Newton-Raphson fit of the Exponential model did not converge, using BFGS.")
+
+        if result is None:
+            return super()._fit_model(likelihood, Ts, Xs, E, weights, entries, fit_options,
+                                      show_progress=show_progress, user_supplied_initial_point=user_supplied_initial_point)
+
+        # The attributes lifelines' _fit_model sets for score() and the robust standard errors
+        self._initial_point_dicts = [self._create_initial_point(Ts, E, entries, weights, Xs)]
+        self._neg_likelihood_with_penalty_function = partial(
+            self._create_neg_likelihood_with_penalty_function, likelihood=likelihood, penalty=self._add_penalty)
+        self._neg_likelihood = partial(self._create_neg_likelihood_with_penalty_function, likelihood=likelihood)
+
+        beta, log_likelihood, hessian = result
+        return {'lambda_': beta}, log_likelihood, hessian
+
+
+# The candidate models compared by AFTModelSelector, in the order used to break ties in AIC
+CANDIDATE_MODELS = {
+    'Weibull': WeibullAFTFitter,
+    'Exponential': ExponentialAFTFitter,
+    'LogNormal': LogNormalAFTFitter,
+    'LogLogistic': LogLogisticAFTFitter,
+}
+
+
+def _fit_candidate(model_name: str, data: pd.DataFrame, duration_col: str, event_col: str):
+    """
+    Fits one candidate model. Defined at module level so that it can be run in a worker process.
+
+    Parameters:
+    - model_name (str): The key of the model in CANDIDATE_MODELS.
+    - data (pd.DataFrame): The input DataFrame containing survival data.
+    - duration_col (str): The column name in the DataFrame representing the duration or time-to-event.
+    - event_col (str): The column name in the DataFrame representing the event indicator.
+
+    Returns:
+    - tuple: The model name, the fitted model (None if it did not converge), the wall time in seconds
+      and the convergence error message (None if it converged).
+    """
+    start = time.perf_counter()
+    model = CANDIDATE_MODELS[model_name]()
+    try:
+        model.fit(data, duration_col=duration_col, event_col=event_col)
+    except ConvergenceError as e:
+        return model_name, None, time.perf_counter() - start, str(e)
+    return model_name, model, time.perf_counter() - start, None
+
+
 class AFTModelSelector:
     """
     A class for selecting the best AFT (Accelerated Failure Time) model among Weibull, Exponential,
@@ -41,58 +175,168 @@ class AFTModelSelector:
     - primary_col(str): The column name in the DataFrame representing the primary key.
     - duration_col (str): The column name in the DataFrame representing the duration or time-to-event.
     - event_col (str): The column name in the DataFrame representing the event indicator.
+    - cache (ModelCache): An optional cache of fitted models, used to skip the fitting when the data has not changed.
 
     Attributes:
     - data (pd.DataFrame): The input DataFrame containing survival data.
     - primary(str): The column name in the DataFrame representing the primary key.
     - duration_col (str): The column name in the DataFrame representing the duration or time-to-event.
     - event_col (str): The column name in the DataFrame representing the event indicator.
+    - cache (ModelCache): The cache of fitted models, or None.
     - aft_model (lifelines.Fitter): The selected AFT model based on AIC.
+    - selection_trail (list): The decisions of the last model selection, one dict (stage, model, aic, decision) each.
     - predictions_df (pd.DataFrame): DataFrame containing churn and CLV predictions for a specified number of time periods.
     """
     
-    def __init__(self, data: pd.DataFrame , primary_col:str,  duration_col : str, event_col: str):
+    def __init__(self, data: pd.DataFrame , primary_col:str,  duration_col : str, event_col: str, cache: ModelCache = None):
         self.data = data
         self.primary = primary_col
         self.duration_col = duration_col
         self.event_col = event_col
+        self.cache = cache
         self.aft_model = None
         self.predictions_df = None
+        self.selection_trail = []
 
             
             
-    def select_best_model(self):
+    @_stage('select_best_model')
+    @profiled('select_best_model')
+    def select_best_model(self, n_jobs: int = 1, racing: bool = False, sample_size: int = 10000,
+                          aic_margin: float = 10.0, random_state: int = 0):
         """
         Selects the best AFT model among Weibull, Exponential, Log-Normal, and Log-Logistic models based on AIC.
         Stores the selected model in the 'aft_model' attribute.
+
+        Candidates that fail to converge are skipped. Ties in AIC are broken by the order of CANDIDATE_MODELS,
+        so the selection does not depend on the order in which the fits finish.
+        When a cache is set and holds a model for the same data, that model is reloaded and nothing is fitted.
+
+        In racing mode, every candidate is first fitted on a subsample stratified by the event column, the candidates
+        whose AIC on the subsample exceeds the best one by more than aic_margin are dropped, and only the remaining
+        ones are fitted on the full data. The decisions are logged and stored in the 'selection_trail' attribute.
+        Racing is skipped when the data has no more than sample_size rows.
+
+        Parameters:
+        - n_jobs (int): The number of processes used to fit the candidates. 1 fits them one after another
+          in the current process, -1 or None uses all the available cores.
+        - racing (bool): Whether to race the candidates on a subsample first (False fits every candidate on the full data).
+        - sample_size (int): The number of rows of the subsample in racing mode.
+        - aic_margin (float): The AIC difference on the subsample above which a candidate is dropped in racing mode.
+        - random_state (int): The seed of the subsample.
         """
-        models = {
-            'Weibull': WeibullAFTFitter(),
-            'Exponential': ExponentialAFTFitter(),
-            'LogNormal': LogNormalAFTFitter(),
-            'LogLogistic': LogLogisticAFTFitter(),
-        }
+        # Handle zero values in the duration column, without modifying the input DataFrame
+        data = self.data.assign(**{self.duration_col: self.data[self.duration_col].replace(0, 0.0001)})
+        self.selection_trail = []
+
+        if racing and len(data) <= sample_size:
+            logger.info("Racing skipped: the data has only %d rows (sample_size=%d)", len(data), sample_size)
+            racing = False
+
+        if self.cache is not None:
+            # A racing run may drop the best candidate, so its result is never returned to an exhaustive selection
+            selection = ('racing', sample_size, aic_margin, random_state) if racing else None
+            cache_key = self.cache.make_key(data, self.duration_col, self.event_col, selection)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                logger.warning("\nBest Model: %s with AIC: %s (from cache)", cached['model_name'], cached['aic'])
+                self.aft_model = cached['model']
+                return
+
+        candidates = list(CANDIDATE_MODELS)
+        if racing:
+            candidates = self._race(data, candidates, n_jobs, sample_size, aic_margin, random_state)
+
+        models = self._fit_candidates(data, candidates, n_jobs, 'full')
 
         best_aic = float('inf')
         best_model = None
-
-        # Handle zero values in the duration column
-        self.data[self.duration_col] = self.data[self.duration_col].replace(0, 0.0001)
-
         for model_name, model in models.items():
-            model.fit(self.data, duration_col= self.duration_col, event_col= self.event_col)
-
-            aic = model.AIC_
-            logger.info(f"{model_name} AIC: {aic}")
-    
-            if aic < best_aic:
-                best_aic = aic
+            if model.AIC_ < best_aic:
+                best_aic = model.AIC_
                 best_model = model_name
 
-        logger.warning(f"\nBest Model: {best_model} with AIC: {best_aic}")
+        if best_model is None:
+            raise ConvergenceError("None of the candidate AFT models converged.")
+
+        logger.warning("\nBest Model: %s with AIC: %s", best_model, best_aic)
+        self.selection_trail.extend(
+            {'stage': 'full', 'model': model_name, 'aic': model.AIC_,
+             'decision': 'selected' if model_name == best_model else 'rejected'}
+            for model_name, model in models.items()
+        )
         self.aft_model = models[best_model]
 
+        if self.cache is not None:
+            aics = {model_name: model.AIC_ for model_name, model in models.items()}
+            self.cache.put(cache_key, best_model, self.aft_model, best_aic, aics)
 
+    def _race(self, data: pd.DataFrame, candidates: list, n_jobs: int, sample_size: int, aic_margin: float,
+              random_state: int) -> list:
+        """
+        Fits the candidates on a subsample of data stratified by the event column and returns the ones whose AIC
+        is within aic_margin of the best one, in the order of CANDIDATE_MODELS (every candidate if none converged).
+        """
+        # The same fraction of every event class, so the subsample has the event rate of the data
+        fraction = sample_size / len(data)
+        sample = data.groupby(self.event_col, group_keys=False).sample(frac=fraction, random_state=random_state)
+        models = self._fit_candidates(sample, candidates, n_jobs, 'subsample')
+        if not models:
+            logger.warning("No candidate converged on the subsample, every candidate is fitted on the full data")
+            return candidates
+
+        best_aic = min(model.AIC_ for model in models.values())
+        survivors = []
+        for model_name in candidates:
+            if model_name not in models:
+                decision = 'dropped (did not converge)'
+                aic = None
+            else:
+                aic = models[model_name].AIC_
+                decision = 'kept' if aic <= best_aic + aic_margin else f'dropped (AIC +{aic - best_aic:.2f})'
+            if decision == 'kept':
+                survivors.append(model_name)
+            logger.info("Racing on %d rows: %s %s", len(sample), model_name, decision)
+            self.selection_trail.append({'stage': 'subsample', 'model': model_name, 'aic': aic, 'decision': decision})
+        return survivors
+
+    def _fit_candidates(self, data: pd.DataFrame, candidates: list, n_jobs: int, stage: str) -> dict:
+        """
+        Fits candidate models on data, in worker processes if n_jobs > 1, and returns the ones that converged
+        by name, in the order of candidates.
+        """
+        if n_jobs is None or n_jobs < 0:
+            n_jobs = os.cpu_count() or 1
+        n_jobs = min(n_jobs, len(candidates))
+
+        if n_jobs > 1:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [
+                    executor.submit(_fit_candidate, model_name, data, self.duration_col, self.event_col)
+                    for model_name in candidates
+                ]
+                results = [future.result() for future in futures]
+        else:
+            results = [
+                _fit_candidate(model_name, data, self.duration_col, self.event_col)
+                for model_name in candidates
+            ]
+
+        models = {}
+        for model_name, model, elapsed, error in results:
+            # The fits may have run in worker processes, so their durations are recorded here
+            MODEL_FIT_SECONDS.observe(elapsed, model=model_name, converged=str(model is not None).lower())
+            if model is None:
+                logger.warning("%s did not converge on the %s data and is skipped (%.2fs): %s", model_name, stage, elapsed, error)
+                continue
+
+            models[model_name] = model
+            logger.info("%s AIC on the %s data: %s (%.2fs)", model_name, stage, model.AIC_, elapsed)
+        return models
+
+
+    @_stage('fit_and_predict')
+    @profiled('fit_and_predict')
     def fit_and_predict(self, n_time_periods: int):
         """
         Fits the selected AFT model and generates churn predictions for a specified number of time periods.
@@ -108,35 +352,30 @@ class AFTModelSelector:
             logger.warning("Please run select_best_model() first.")
             return
 
-        # Handle zero values in the duration column
-        self.data[self.duration_col] = self.data[self.duration_col].replace(0, 0.0001)
-
-        predictions_df_list = []
-
-        for time_period in range(1, n_time_periods + 1):
-            customer_data = pd.DataFrame({
-                'customer_id': self.data[self.primary],
-                'pred_period': time_period
-            })
-
-            # Generate survival predictions 
-            predictions = self.aft_model.predict_survival_function(self.data, times=[time_period])
-
-            #obtaining churn predictions
-            churn = round(1 - predictions, 5)
-            # Convert predictions to a DataFrame
-            predictions_df = pd.DataFrame(churn.T.values, columns=['churn_rate'])
-
-            # Concatenate customer_id and time_period with predictions DataFrame
-            result_df = pd.concat([customer_data, predictions_df], axis=1)
-
-            # Append to the list
-            predictions_df_list.append(result_df)
-
-        # Concatenate all predictions into a single DataFrame
-        self.predictions_df = pd.concat(predictions_df_list, ignore_index=True)
+        time_periods = np.arange(1, n_time_periods + 1)
+
+        # Generate survival predictions for all the time periods at once (periods x customers)
+        if type(self.aft_model).__name__ in FAMILIES:
+            scorer = SurvivalScorer.from_model(self.aft_model)
+            survival = scorer.survival_function(scorer.design_matrix(self.data), time_periods).T
+        else:
+            # Not one of the candidate families, lifelines evaluates it
+            survival = self.aft_model.predict_survival_function(self.data, times=time_periods).to_numpy()
+
+        #obtaining churn predictions
+        churn = np.round(1 - survival, 5)
+
+        # Build the long format (all customers for period 1, then for period 2, ...) straight from the array
+        customer_ids = self.data[self.primary].to_numpy()
+        self.predictions_df = pd.DataFrame({
+            'customer_id': np.tile(customer_ids, n_time_periods),
+            'pred_period': np.repeat(time_periods, len(customer_ids)),
+            'churn_rate': churn.ravel(),
+        })
         logger.info("The AFT model was run successfully.")
 
+    @_stage('calculate_clv')
+    @profiled('calculate_clv')
     def calculate_clv(self, MM=1300, r=0.1):
         """
         Calculates Customer Lifetime Value (CLV) for each customer in 'predictions_df' attribute 
@@ -150,41 +389,41 @@ class AFTModelSelector:
         - str: A message indicating the 'predictions_df' attribute was updated successfully. 
         """
         
-        predictions_dfs = []  # List to store individual CLV prediction DataFrames
         if self.predictions_df is None:
             logger.warning("Please run fit_and_predict() first.")
             return
-        
-        #Making the data long format
-        data_clv = self.predictions_df.pivot(index='customer_id', columns='pred_period', values='churn_rate')
-        #Calculating the Survival Rates from Churn Rates 
-        data_clv = 1 - data_clv
-
-        # Iterating over an increasing number of columns
-        for i in range(1, len(data_clv.columns) + 1):
-            # Selecting the first i columns
-            subset_data = data_clv.iloc[:, :i]
-    
-            # Calculating CLV 
-            data_clv1 = subset_data.copy()
-            sequence = list(range(1, len(data_clv1.columns) + 1))
 
-            for num in sequence:
-                data_clv1.iloc[:, num - 1] /= (1 + r/12) ** (num - 1)
+        # Locating every row of the long format in a customers x periods matrix
+        customer_codes, customers = pd.factorize(self.predictions_df['customer_id'], sort=True)
+        period_codes, periods = pd.factorize(self.predictions_df['pred_period'], sort=True)
 
-            data_clv1['CLV'] = MM * data_clv1.sum(axis=1)
-            
-            predictions_dfs.append(data_clv1['CLV'])
+        #Calculating the Survival Rates from Churn Rates
+        survival = np.full((len(customers), len(periods)), np.nan)
+        survival[customer_codes, period_codes] = 1 - self.predictions_df['churn_rate'].to_numpy(dtype=float)
 
-        clv_prediction = pd.concat(predictions_dfs, axis=1)
-        clv_prediction.columns = range(1, len(predictions_dfs) + 1)
+        #Calculating the CLV for every horizon at once and saving the predictions in the long format
+        clv = calculate_clv_matrix(survival, MM=MM, r=r)
+        self.predictions_df['CLV'] = clv[customer_codes, period_codes]
+        logger.info("The CLV predictions were added successfully.")
 
-        #returning to original data format and saving the predictions
-        clv_prediction = clv_prediction.reset_index()
-        clv_prediction = pd.melt(clv_prediction, id_vars=['customer_id'], var_name='pred_period', value_name='CLV')
 
-        #Combining the results and updating the predictions dataframe
-        self.predictions_df = pd.merge(self.predictions_df, clv_prediction, on=['customer_id','pred_period'], how='left')
-        logger.info("The CLV predictions were added successfully.")
-        
+def calculate_clv_matrix(survival, MM=1300, r=0.1):
+    """
+    Calculates Customer Lifetime Value (CLV) for every customer and every horizon from a survival matrix.
+
+    The CLV of horizon i is MM times the sum of the survival rates of the first i periods, each discounted
+    by (1 + r/12) ** (period - 1), so all horizons are obtained with one discounted cumulative sum.
+    Missing survival rates do not contribute to the sum.
 
+    Parameters:
+    - survival (np.ndarray): A customers x periods matrix of survival rates, with periods in increasing order.
+    - MM (float): A constant representing the monetary value.
+    - r (float): The periodic interest rate for discounting.
+
+    Returns:
+    - np.ndarray: A customers x periods matrix with the CLV of each customer for each horizon.
+    """
+    # The T discount factors are computed with Python floats, because numpy's vectorised power
+    # rounds differently in the last bit and the results should not depend on it
+    discount = np.array([(1 + r/12) ** k for k in range(survival.shape[1])])
+    return MM * np.nancumsum(survival / discount, axis=1)
@@ -0,0 +1,173 @@
+"""
+Module: model_cache.py
+
+This module defines a class called 'ModelCache' which keeps fitted AFT models on disk, so that a model selection
+run on training data that has not changed since the previous run can reload the winning model instead of refitting
+every candidate.
+
+Entries are keyed by a fingerprint of the training DataFrame together with the duration and event column names.
+Each entry is a pickle file in the cache directory; the least recently used entries are evicted once the directory
+grows beyond a size limit.
+
+Methods:
+
+- make_key(data: pd.DataFrame, duration_col: str, event_col: str, selection: tuple) -> str:
+    Computes the fingerprint of the training data used as the cache key.
+
+- get(self, key: str) -> dict:
+    Loads the cached entry for a key, or returns None.
+
+- put(self, key: str, model_name: str, model, aic: float, aics: dict) -> None:
+    Stores a fitted model and its AIC under a key and evicts old entries if needed.
+
+- invalidate(self, key: str) -> None:
+    Removes one entry, or every entry when no key is given.
+
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import pandas as pd
+from ..logger import CustomFormatter, get_log_level
+
+# Initialize and configure the logger
+logger = logging.getLogger(os.path.basename(__file__))
+logger.setLevel(get_log_level(logger.name))
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(CustomFormatter())
+logger.addHandler(ch)
+
+
+class ModelCache:
+
+    def __init__(self, cache_dir: str = 'model_cache', max_bytes: int = 256 * 1024 * 1024) -> None:
+        """
+        Constructor for the ModelCache class.
+
+        Parameters:
+        - cache_dir (str): The directory where the fitted models are stored. It is created if it does not exist.
+        - max_bytes (int): The maximum total size of the cached files, the least recently used ones are evicted above it.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(data: pd.DataFrame, duration_col: str, event_col: str, selection: tuple = None) -> str:
+        """
+        Computes the fingerprint of the training data used as the cache key.
+
+        The key covers the values and the index of the DataFrame, its column names and dtypes,
+        the duration and event column names, and the selection mode when one is given.
+
+        Parameters:
+        - data (pd.DataFrame): The training DataFrame.
+        - duration_col (str): The column name representing the duration or time-to-event.
+        - event_col (str): The column name representing the event indicator.
+        - selection (tuple): The parameters of a selection that may not compare every candidate on the full data
+          (e.g. racing), None for the exhaustive selection.
+
+        Returns:
+        - str: The hexadecimal SHA-256 fingerprint.
+        """
+        digest = hashlib.sha256()
+        digest.update(repr((duration_col, event_col)).encode())
+        if selection is not None:
+            # The exhaustive keys are left unchanged, so the entries cached before remain valid
+            digest.update(repr(selection).encode())
+        digest.update(repr([(str(col), str(dtype)) for col, dtype in data.dtypes.items()]).encode())
+        digest.update(pd.util.hash_pandas_object(data, index=True).to_numpy().tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.pkl')
+
+    def get(self, key: str) -> dict:
+        """
+        Loads the cached entry for a key.
+
+        Parameters:
+        - key (str): The cache key returned by make_key.
+
+        Returns:
+        - dict: The entry with the 'model_name', 'model', 'aic' and 'aics' keys, or None if the key is not cached.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            logger.info('Model cache miss: %s', key)
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            logger.warning('Discarding unreadable model cache entry %s: %s', key, e)
+            self.invalidate(key)
+            return None
+
+        # The modification time is used as the last access time for the eviction
+        os.utime(path)
+        logger.info('Model cache hit: %s (%s)', key, entry['model_name'])
+        return entry
+
+    def put(self, key: str, model_name: str, model, aic: float, aics: dict = None) -> None:
+        """
+        Stores a fitted model and its AIC under a key and evicts the least recently used entries above max_bytes.
+
+        Parameters:
+        - key (str): The cache key returned by make_key.
+        - model_name (str): The name of the model.
+        - model (lifelines.Fitter): The fitted model.
+        - aic (float): The AIC of the model.
+        - aics (dict): The AIC of every candidate that was compared, for the record.
+        """
+        path = self._path(key)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'model_name': model_name, 'model': model, 'aic': aic, 'aics': aics or {}}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        # Replacing the file atomically so a concurrent reader never sees a partial entry
+        os.replace(tmp_path, path)
+        logger.info('Model cache stored: %s (%s)', key, model_name)
+        self._evict()
+
+    def invalidate(self, key: str = None) -> None:
+        """
+        Removes the entry of a key, or every entry when no key is given.
+
+        Parameters:
+        - key (str): The cache key to remove. All the entries are removed if None.
+        """
+        paths = [self._path(key)] if key else self._entries()
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        logger.warning('Model cache invalidated: %s', key or 'all entries')
+
+    def _entries(self) -> list:
+        return [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.pkl')]
+
+    def _evict(self) -> None:
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        # Removing the least recently used entries first
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.info('Model cache evicted: %s', os.path.basename(path))
@@ -0,0 +1,223 @@
+"""
+Module: scoring.py
+
+This module defines a class called 'SurvivalScorer', which evaluates the survival function S(t|x) of a fitted AFT
+model with NumPy only, from the coefficients of the model.
+
+The four families compared by AFTModelSelector have a closed-form survival function:
+- Weibull: S(t) = exp(-(t / lambda) ** rho)
+- Exponential: S(t) = exp(-t / lambda)
+- LogNormal: S(t) = 1 - Phi((log(t) - mu) / sigma)
+- LogLogistic: S(t) = 1 / (1 + (t / alpha) ** beta)
+where each parameter is exp (or, for mu, the identity) of a linear predictor of the covariates.
+
+lifelines' predict_survival_function computes the same values, but builds, aligns and transposes DataFrames around
+them. The scorer computes every linear predictor with one matrix product and writes the survival rates into a
+preallocated customers x times array, optionally a chunk of customers at a time so that the temporary arrays stay
+small. The design matrix may be float32 to halve its memory; the computations then run in float32.
+
+The results agree with lifelines within TOLERANCE (the maximum absolute difference of the survival rates), which
+check() verifies on a sample of the data.
+
+Methods:
+
+- SurvivalScorer.from_model(model) -> SurvivalScorer:
+    Extracts the scorer of a fitted Weibull, Exponential, LogNormal or LogLogistic AFT model.
+
+- SurvivalScorer.design_matrix(self, df: pd.DataFrame, dtype) -> np.ndarray:
+    Builds the design matrix of the scorer from a DataFrame of covariates.
+
+- SurvivalScorer.survival_function(self, X: np.ndarray, times, chunksize: int) -> np.ndarray:
+    Evaluates the survival rates of every customer at every time.
+
+- SurvivalScorer.check(self, model, df: pd.DataFrame, times, tolerance: float, sample_size: int) -> float:
+    Compares the survival rates with lifelines' on a sample of the data.
+
+"""
+
+import logging
+import os
+import numpy as np
+import pandas as pd
+from scipy.special import log_ndtr
+from ..logger import CustomFormatter, get_log_level
+
+# Initialize and configure the logger
+logger = logging.getLogger(os.path.basename(__file__))
+logger.setLevel(get_log_level(logger.name))
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(CustomFormatter())
+logger.addHandler(ch)
+
+# The maximum absolute difference with lifelines' survival rates, per dtype of the design matrix
+TOLERANCE = {np.dtype(np.float64): 1e-9, np.dtype(np.float32): 1e-5}
+
+# lifelines clips the exponents at the same bound (lifelines.utils.safe_exp)
+_MAX_EXP = np.log(np.finfo(float).max) - 75
+
+
+def _safe_exp(x):
+    return np.exp(np.minimum(x, _MAX_EXP))
+
+
+def _weibull(lp, log_t):
+    # lp[:, 0] is log(lambda) and lp[:, 1] is log(rho)
+    rho = _safe_exp(lp[:, 1:2])
+    return np.exp(-_safe_exp(rho * (log_t - lp[:, 0:1])))
+
+
+def _exponential(lp, log_t):
+    # lp[:, 0] is log(lambda)
+    return np.exp(-np.exp(log_t - lp[:, 0:1]))
+
+
+def _log_normal(lp, log_t):
+    # lp[:, 0] is mu and lp[:, 1] is log(sigma)
+    z = (log_t - lp[:, 0:1]) / _safe_exp(lp[:, 1:2])
+    return np.exp(log_ndtr(-z))
+
+
+def _log_logistic(lp, log_t):
+    # lp[:, 0] is log(alpha) and lp[:, 1] is log(beta)
+    beta = np.exp(lp[:, 1:2])
+    return np.exp(-np.logaddexp(beta * (log_t - lp[:, 0:1]), 0))
+
+
+# The lifelines class name of each family, its parameters in the order of the linear predictors
+# and its survival function of the linear predictors and log(t)
+FAMILIES = {
+    'WeibullAFTFitter': (('lambda_', 'rho_'), _weibull),
+    'ExponentialAFTFitter': (('lambda_',), _exponential),
+    'LogNormalAFTFitter': (('mu_', 'sigma_'), _log_normal),
+    'LogLogisticAFTFitter': (('alpha_', 'beta_'), _log_logistic),
+}
+
+
+class SurvivalScorer:
+    """
+    The survival function of a fitted AFT model, evaluated with NumPy.
+
+    Parameters:
+    - family (str): The lifelines class name of the model, a key of FAMILIES.
+    - columns (list): The covariates of the design matrix, 'Intercept' being a column of ones.
+    - coefficients (np.ndarray): A covariates x parameters matrix of coefficients, in the order of the parameters
+      of the family (zero where a parameter does not depend on a covariate).
+
+    Attributes:
+    - family (str): The lifelines class name of the model.
+    - columns (list): The covariates of the design matrix.
+    - coefficients (np.ndarray): The covariates x parameters matrix of coefficients.
+    """
+
+    def __init__(self, family: str, columns: list, coefficients: np.ndarray) -> None:
+        if family not in FAMILIES:
+            raise ValueError(f'Unsupported model family: {family}')
+        self.family = family
+        self.columns = list(columns)
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self._survival = FAMILIES[family][1]
+
+    @classmethod
+    def from_model(cls, model) -> 'SurvivalScorer':
+        """
+        Extracts the scorer of a fitted Weibull, Exponential, LogNormal or LogLogistic AFT model.
+
+        Parameters:
+        - model (lifelines.Fitter): The fitted model, e.g. AFTModelSelector.aft_model.
+
+        Returns:
+        - SurvivalScorer: The scorer of the model.
+
+        Raises:
+        - ValueError: If the model is not one of the supported families.
+        """
+        family = type(model).__name__
+        if family not in FAMILIES:
+            raise ValueError(f'Unsupported model family: {family}')
+        parameters = FAMILIES[family][0]
+
+        # The union of the covariates of every parameter, in the order of the first one
+        columns = []
+        for parameter in parameters:
+            columns.extend(c for c in model.params_.loc[parameter].index if c not in columns)
+        coefficients = np.zeros((len(columns), len(parameters)))
+        for j, parameter in enumerate(parameters):
+            params = model.params_.loc[parameter]
+            coefficients[[columns.index(c) for c in params.index], j] = params.to_numpy(dtype=float)
+        return cls(family, columns, coefficients)
+
+    def design_matrix(self, df: pd.DataFrame, dtype=np.float64) -> np.ndarray:
+        """
+        Builds the design matrix of the scorer from a DataFrame of covariates (e.g. the output of format_dataframe).
+        The other columns of the DataFrame are ignored.
+
+        Parameters:
+        - df (pd.DataFrame): The covariates of the customers.
+        - dtype (np.dtype): np.float64 (the default) or np.float32.
+
+        Returns:
+        - np.ndarray: A customers x covariates matrix.
+
+        Raises:
+        - ValueError: If a covariate of the model is missing from the DataFrame.
+        """
+        missing = [c for c in self.columns if c not in df.columns and c != 'Intercept']
+        if missing:
+            raise ValueError(f'The DataFrame is missing the covariates: {missing}')
+
+        X = np.empty((len(df), len(self.columns)), dtype=dtype)
+        for j, column in enumerate(self.columns):
+            X[:, j] = 1 if column == 'Intercept' and column not in df.columns else df[column].to_numpy()
+        return X
+
+    def survival_function(self, X: np.ndarray, times, chunksize: int = None) -> np.ndarray:
+        """
+        Evaluates the survival rates of every customer at every time.
+
+        Parameters:
+        - X (np.ndarray): The customers x covariates design matrix (see design_matrix), float64 or float32.
+        - times (array-like): The times at which the survival function is evaluated.
+        - chunksize (int): The number of customers evaluated at once, None to evaluate them all at once.
+
+        Returns:
+        - np.ndarray: A customers x times matrix of survival rates, of the dtype of X.
+        """
+        dtype = X.dtype if X.dtype in (np.float32, np.float64) else np.dtype(np.float64)
+        coefficients = self.coefficients.astype(dtype)
+        log_t = np.log(np.clip(np.asarray(times, dtype=dtype), 1e-100 if dtype == np.float64 else 1e-30, None))
+
+        n = X.shape[0]
+        chunksize = chunksize or max(n, 1)
+        survival = np.empty((n, len(log_t)), dtype=dtype)
+        for start in range(0, n, chunksize):
+            lp = np.asarray(X[start:start + chunksize], dtype=dtype) @ coefficients
+            survival[start:start + chunksize] = self._survival(lp, log_t)
+        return survival
+
+    def check(self, model, df: pd.DataFrame, times, tolerance: float = None, sample_size: int = 1000) -> float:
+        """
+        Compares the survival rates of the scorer with lifelines' predict_survival_function on a sample of the data.
+
+        Parameters:
+        - model (lifelines.Fitter): The fitted model the scorer was extracted from.
+        - df (pd.DataFrame): The covariates of the customers.
+        - times (array-like): The times at which the survival function is evaluated.
+        - tolerance (float): The maximum allowed absolute difference (default: TOLERANCE of float64).
+        - sample_size (int): The number of customers compared.
+
+        Returns:
+        - float: The maximum absolute difference.
+
+        Raises:
+        - ValueError: If the difference exceeds the tolerance.
+        """
+        tolerance = TOLERANCE[np.dtype(np.float64)] if tolerance is None else tolerance
+        sample = df.iloc[:sample_size]
+        expected = model.predict_survival_function(sample, times=times).to_numpy().T
+        difference = float(np.max(np.abs(self.survival_function(self.design_matrix(sample), times) - expected),
+                                  initial=0.0))
+        if difference > tolerance:
+            raise ValueError(f'The {self.family} scorer differs from lifelines by {difference} (tolerance {tolerance})')
+        logger.debug('The %s scorer agrees with lifelines within %s', self.family, difference)
+        return difference
@@ -0,0 +1,176 @@
+"""
+Module: profiling.py
+
+This module provides opt-in profiling of the API requests and of the AFTModelSelector stages, to find out whether
+the time of a slow request or scoring run goes to SQL paging, pandas, lifelines fitting or the CLV computation.
+
+Profiling is configured through the environment:
+- SA_PROFILE: 'off' (the default), 'on' to profile every request and every AFTModelSelector stage, or 'header' to
+  profile only the requests sent with an 'X-Profile: 1' header.
+- SA_PROFILE_DIR: the directory of the profiles (default: 'profiles').
+- SA_PROFILE_MODE: 'cprofile', 'sampling' or 'both' (the default).
+- SA_PROFILE_INTERVAL: the sampling interval in seconds (default: 0.005).
+
+Every profiled call writes, in SA_PROFILE_DIR, files named <timestamp>-<pid>-<name>:
+- .prof: the cProfile statistics of the calling thread (open them with pstats or snakeviz).
+- .collapsed: the stacks seen by a sampling thread, one 'frame;frame;frame count' line per stack, ready for
+  flamegraph.pl or speedscope. The stacks of the other threads (e.g. the database threads of the API) are included
+  when requested, prefixed with the thread name.
+
+When SA_PROFILE is off, the decorator returns the functions unchanged and the API adds no middleware, so profiling
+costs nothing.
+
+Methods:
+
+- Profiler(name: str, profile_dir: str, mode: str, interval: float, all_threads: bool):
+    A context manager profiling its block and writing the profile files when it exits.
+
+- profiled(name: str):
+    A decorator profiling every call of a function when SA_PROFILE is 'on'.
+
+"""
+
+import cProfile
+import functools
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+
+
+def _setting(name: str, default: str) -> str:
+    return os.environ.get(name, default).strip().lower()
+
+
+# Read once, so that a disabled profiler costs nothing
+MODE = _setting('SA_PROFILE', 'off')
+MODE = {'1': 'on', 'true': 'on'}.get(MODE, MODE)
+if MODE not in ('on', 'header'):
+    MODE = 'off'
+PROFILE_DIR = os.environ.get('SA_PROFILE_DIR', 'profiles')
+PROFILE_OUTPUT = _setting('SA_PROFILE_MODE', 'both')
+SAMPLING_INTERVAL = float(os.environ.get('SA_PROFILE_INTERVAL', 0.005))
+
+# Whether the current thread is already running a cProfile profiler (they cannot be nested)
+_active = threading.local()
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'.replace(';', ':')
+
+
+def _collapse(frame) -> str:
+    # The frames from the root of the stack to the sampled frame, separated by ';'
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class Profiler:
+    """
+    A context manager profiling its block with cProfile and/or a sampling thread, and writing the profile files
+    when it exits. The paths of the files are in the 'paths' attribute afterwards.
+
+    Parameters:
+    - name (str): The name of the profiled call, used in the file names.
+    - profile_dir (str): The directory of the profile files (default: SA_PROFILE_DIR).
+    - mode (str): 'cprofile', 'sampling' or 'both' (default: SA_PROFILE_MODE).
+    - interval (float): The sampling interval in seconds (default: SA_PROFILE_INTERVAL).
+    - all_threads (bool): Whether the sampling covers every thread of the process or only the calling one.
+    """
+
+    def __init__(self, name: str, profile_dir: str = None, mode: str = None, interval: float = None,
+                 all_threads: bool = False) -> None:
+        self.name = name
+        self.profile_dir = profile_dir or PROFILE_DIR
+        self.mode = mode or PROFILE_OUTPUT
+        self.interval = interval or SAMPLING_INTERVAL
+        self.all_threads = all_threads
+        safe_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', name).strip('_')
+        now = time.time()
+        self.profile_id = (f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}.{int(now % 1 * 1e6):06d}"
+                           f"-{os.getpid()}-{safe_name}")
+        self.paths = []
+        self._profile = None
+        self._samples = StackCounter()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._thread_id = None
+
+    def __enter__(self):
+        self._thread_id = threading.get_ident()
+        if self.mode in ('sampling', 'both'):
+            self._sampler = threading.Thread(target=self._sample, name='sa-profiler', daemon=True)
+            self._sampler.start()
+        if self.mode in ('cprofile', 'both') and not getattr(_active, 'profiling', False):
+            self._profile = cProfile.Profile()
+            try:
+                self._profile.enable()
+                _active.profiling = True
+            except ValueError:
+                # Another profiler is already active in the process (Python 3.12+)
+                self._profile = None
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self._profile is not None:
+            self._profile.disable()
+            _active.profiling = False
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+        self._write()
+
+    def _sample(self) -> None:
+        sampler_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if self.all_threads:
+                if len(names) != threading.active_count():
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in frames.items():
+                    if thread_id != sampler_id:
+                        self._samples[f'{names.get(thread_id, thread_id)};{_collapse(frame)}'] += 1
+            elif self._thread_id in frames:
+                self._samples[_collapse(frames[self._thread_id])] += 1
+
+    def _write(self) -> None:
+        os.makedirs(self.profile_dir, exist_ok=True)
+        base = os.path.join(self.profile_dir, self.profile_id)
+        if self._profile is not None:
+            self._profile.dump_stats(f'{base}.prof')
+            self.paths.append(f'{base}.prof')
+        if self._sampler is not None:
+            with open(f'{base}.collapsed', 'w') as f:
+                for stack, count in self._samples.most_common():
+                    f.write(f'{stack} {count}\n')
+            self.paths.append(f'{base}.collapsed')
+
+
+def profiled(name: str):
+    """
+    A decorator profiling every call of a function with Profiler when SA_PROFILE is 'on'.
+    Otherwise the function is returned unchanged.
+
+    Parameters:
+    - name (str): The name of the profiled function, used in the file names.
+
+    Returns:
+    - callable: The decorator.
+    """
+    def decorator(function):
+        if MODE != 'on':
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with Profiler(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,43 +1,245 @@
 import pandas as pd
+import numpy as np
+import json
+import logging
+import os
+from .logger import CustomFormatter, get_log_level
 
 """"
 THIS IS A MODULE FOR UTILITY FUNCTIONS
 """
 
+# Initialize and configure the logger
+logger = logging.getLogger(os.path.basename(__file__))
+logger.setLevel(get_log_level(logger.name))
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(CustomFormatter())
+logger.addHandler(ch)
+
 def format_dataframe(df):
     """
     Converts categorical variables in a DataFrame to binary columns using one-hot encoding and makes sure that numeric variables are of correct type.
 
+    The columns and categories are inferred from df itself. To transform batches scored later with the columns
+    learned from the training data, fit a DataFrameEncoder once and reuse it.
+
     Parameters:
         df (pd.DataFrame): The input DataFrame.
 
     Returns:
         pd.DataFrame: The DataFrame with categorical variables converted to binary columns.
     """
-    # Identify string variables
-    string_variables = df.select_dtypes(include=['object']).columns
-
-    #Exclude columns where all values can be converted to numeric
-    numeric_variables = df.apply(pd.to_numeric, errors='coerce').notna().all()
-    string_variables = string_variables.difference(numeric_variables[numeric_variables].index)
     df.reset_index(drop=True, inplace=True)
-    
-    # Filter DataFrame to keep only string variables
-    string_df = df[string_variables]
+    return DataFrameEncoder().fit_transform(df)
+
+
+class DataFrameEncoder:
+    """
+    A fit / transform version of format_dataframe: the numeric and categorical columns and the category levels
+    are learned once from the training data, and every later batch is transformed into exactly the same columns.
+
+    - Numeric columns (the columns whose values can all be converted to numbers) are converted with pd.to_numeric
+      and cast to their training dtype when the batch has no missing values.
+    - Categorical columns (the other object columns) are one-hot encoded with the training levels, the first level
+      being dropped. Missing values and levels unseen in training get zeros in every binary column.
+    - The other columns are passed through unchanged.
+
+    The encoder can be saved to and loaded from a JSON file.
+
+    Attributes:
+        columns_ (list): The input columns, in the training order.
+        numeric_dtypes_ (dict): The numeric columns and their dtypes.
+        categories_ (dict): The categorical columns and their levels.
+        feature_names_ (list): The output columns.
+    """
+
+    def __init__(self):
+        self.columns_ = None
+        self.numeric_dtypes_ = None
+        self.categories_ = None
+        self.feature_names_ = None
+
+    def fit(self, df):
+        """
+        Learns the numeric and categorical columns and the category levels of the training data.
+
+        Parameters:
+            df (pd.DataFrame): The training DataFrame.
+
+        Returns:
+            DataFrameEncoder: The fitted encoder.
+        """
+        # Identify string variables
+        string_variables = df.select_dtypes(include=['object']).columns
+
+        #Exclude columns where all values can be converted to numeric
+        converted = df.apply(pd.to_numeric, errors='coerce')
+        numeric_variables = converted.notna().all()
+        string_variables = string_variables.difference(numeric_variables[numeric_variables].index)
+
+        self.columns_ = list(df.columns)
+        self.numeric_dtypes_ = {column: str(converted[column].dtype)
+                                for column in numeric_variables[numeric_variables].index}
+        # The levels get_dummies would use (the sorted unique values)
+        self.categories_ = {column: pd.Categorical(df[column]).categories.tolist() for column in string_variables}
+        self._set_feature_names()
+        return self
+
+    def _set_feature_names(self):
+        self._dummy_columns = [f'{column}_{level}' for column, levels in self.categories_.items() for level in levels[1:]]
+        self.feature_names_ = [column for column in self.columns_ if column not in self.categories_] + self._dummy_columns
+
+    def transform(self, df):
+        """
+        Transforms a batch into the columns learned by fit. The input DataFrame is not modified,
+        the output has a new RangeIndex.
+
+        Parameters:
+            df (pd.DataFrame): The batch to transform, with at least the training columns.
+
+        Returns:
+            pd.DataFrame: The transformed batch, with the columns in feature_names_.
+        """
+        if self.feature_names_ is None:
+            raise ValueError('The DataFrameEncoder is not fitted, call fit() or load() first.')
+        missing = [column for column in self.columns_ if column not in df.columns]
+        if missing:
+            raise ValueError(f'The columns {missing} are missing from the DataFrame')
+
+        # Numeric and passed-through columns, with a fresh index as format_dataframe does
+        output = {}
+        for column in self.columns_:
+            if column in self.categories_:
+                continue
+            values = df[column].reset_index(drop=True)
+            dtype = self.numeric_dtypes_.get(column)
+            if dtype is not None:
+                values = pd.to_numeric(values, errors='coerce')
+                if values.dtype != dtype and not values.isna().any():
+                    values = values.astype(dtype)
+            output[column] = values
+        output_df = pd.DataFrame(output, index=pd.RangeIndex(len(df)))
+
+        # One-hot encoding the categorical columns into a preallocated matrix, from their codes in the training levels
+        dummies = np.zeros((len(df), len(self._dummy_columns)), dtype=int)
+        offset = 0
+        for column, levels in self.categories_.items():
+            codes = pd.Categorical(df[column], categories=levels).codes
+            rows = np.flatnonzero(codes >= 1)
+            dummies[rows, offset + codes[rows] - 1] = 1
+            unseen = int(((codes == -1) & df[column].notna().to_numpy()).sum())
+            if unseen:
+                logger.warning('%d values of %s were not seen in training and are encoded as zeros', unseen, column)
+            offset += max(len(levels) - 1, 0)
+        dummies_df = pd.DataFrame(dummies, columns=self._dummy_columns, index=output_df.index)
 
-    # Dummify the string variables
-    dummies_df = pd.get_dummies(string_df, columns=string_variables, prefix=string_variables,  drop_first=True)
-    dummies_df = dummies_df.astype(int)
+        return pd.concat([output_df, dummies_df], axis=1)
 
-    # Concatenate the dummified variables with the original DataFrame
-    output_df = pd.concat([df, dummies_df], axis=1)
+    def fit_transform(self, df):
+        """
+        Fits the encoder on a DataFrame and transforms it.
 
-    # Convert true numeric values to appropriate numeric type
-    for column in numeric_variables[numeric_variables].index:
-        output_df[column] = pd.to_numeric(df[column], errors='coerce')
+        Parameters:
+            df (pd.DataFrame): The training DataFrame.
+
+        Returns:
+            pd.DataFrame: The transformed DataFrame.
+        """
+        return self.fit(df).transform(df)
+
+    def to_dict(self):
+        """
+        Returns the learned columns and levels as a JSON-serializable dict.
+
+        Returns:
+            dict: The state of the encoder.
+        """
+        return {'columns': self.columns_, 'numeric_dtypes': self.numeric_dtypes_, 'categories': self.categories_}
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        Creates a fitted encoder from a dict returned by to_dict.
+
+        Parameters:
+            state (dict): The state of the encoder.
+
+        Returns:
+            DataFrameEncoder: The fitted encoder.
+        """
+        encoder = cls()
+        encoder.columns_ = list(state['columns'])
+        encoder.numeric_dtypes_ = dict(state['numeric_dtypes'])
+        encoder.categories_ = {column: list(levels) for column, levels in state['categories'].items()}
+        encoder._set_feature_names()
+        return encoder
+
+    def save(self, path):
+        """
+        Saves the fitted encoder to a JSON file.
+
+        Parameters:
+            path (str): The path of the file.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads an encoder saved with save.
+
+        Parameters:
+            path (str): The path of the file.
+
+        Returns:
+            DataFrameEncoder: The fitted encoder.
+        """
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def normalize_fact_data(df, date_format='%d/%m/%Y'):
+    """
+    Validates and normalizes the columns of a FactEmail / FactPushNotification batch in a few vectorized passes.
+
+    - sent_date is parsed with the explicit date_format and stored as an ISO timestamp string
+      ('YYYY-MM-DD HH:MM:SS.ffffff', the format SQLAlchemy uses for DateTime columns in SQLite).
+    - customer_ID and success are coerced to integers (e.g. '918.00' -> 918), success must be 0, 1 or missing.
+
+    Only the columns present in the batch are checked, column names are matched case-insensitively.
+
+    Parameters:
+        df (pd.DataFrame): The input DataFrame.
+        date_format (str): The format of the sent_date values.
+
+    Returns:
+        pd.DataFrame: The normalized DataFrame, with missing values where a row is invalid.
+        pd.Series: A boolean mask which is True for the rows that failed validation.
+    """
+    output_df = df.copy()
+    errors = pd.Series(False, index=df.index)
+    columns = {column.lower(): column for column in df.columns}
 
-    # Drop the original string variables
-    output_df = output_df.drop(columns=string_variables)
+    if 'sent_date' in columns:
+        column = columns['sent_date']
+        sent_date = pd.to_datetime(df[column], format=date_format, errors='coerce')
+        errors |= sent_date.isna()
+        output_df[column] = sent_date.dt.strftime('%Y-%m-%d %H:%M:%S.%f')
 
-    return output_df
+    for name in ['customer_id', 'success']:
+        if name not in columns:
+            continue
+        column = columns[name]
+        values = pd.to_numeric(df[column], errors='coerce')
+        invalid = (values.isna() & df[column].notna()) | (values.notna() & (values % 1 != 0))
+        if name == 'customer_id':
+            # customer_ID is part of the primary key, while a missing success flag is stored as NULL
+            invalid |= values.isna()
+        else:
+            invalid |= values.notna() & ~values.isin([0, 1])
+        errors |= invalid
+        output_df[column] = values.where(~invalid).astype('Int64')
 
+    return output_df, errors